@@ -49,7 +49,6 @@ setup(
     },
     install_requires= [
         'Sphinx',
-        'langid',
         'jieba',
         'python-pinyin',
         'pyxdg',
@@ -7,12 +7,16 @@
 """
 
 from __future__ import annotations
-from typing import List, Tuple, Optional, Any, Dict
+from typing import List, Tuple, Optional, Dict, TYPE_CHECKING
 from dataclasses import dataclass, field
 from abc import ABC, abstractclassmethod
+from bisect import bisect_left
 import itertools
 
-from docutils import nodes
+if TYPE_CHECKING:
+    # NOTE: docutils is imported lazily, command line tool should not pay
+    # for it
+    from docutils import nodes
 
 
 __title__= 'sphinxnotes-snippet'
@@ -30,20 +34,14 @@ class Snippet(ABC):
     documentation. Note that it is not always continuous fragment at text (rst)
     level.
     """
-    _scope:Tuple[int,int] = field(init=False)
+    _scope:Optional[Tuple[int,int]] = field(init=False)
     _refid:Optional[str] = field(init=False)
 
     def __post_init__(self) -> None:
         """Post-init processing routine of dataclass"""
 
-        # Calcuate scope before deepcopy
-        scope = [float('inf'), -float('inf')]
-        for node in self.nodes():
-            if not node.line:
-                continue # Skip node that have None line, I dont know why :'(
-            scope[0] = min(scope[0], line_of_start(node))
-            scope[1] = max(scope[1], line_of_end(node))
-        self._scope = scope
+        # Scope is calculated on demand, see :meth:`locate`
+        self._scope = None
 
         # Find exactly one id attr in nodes
         self._refid = None
@@ -77,6 +75,22 @@ class Snippet(ABC):
         pass
 
 
+    @abstractclassmethod
+    def astext(self) -> str:
+        """Return plain text of snippet's description (for keywords extraction)."""
+        pass
+
+
+    def language(self) -> Optional[str]:
+        """Return the (programing) language that appears in snippet."""
+        return None
+
+
+    def code(self) -> Optional[str]:
+        """Return the code that appears in snippet (for code indexing)."""
+        return None
+
+
     def file(self) -> str:
         """Return source file path of snippet"""
         # All nodes should have same source file
@@ -91,9 +105,29 @@ class Snippet(ABC):
         A scope is a left closed and right open interval of the line number
         ``[left, right)``.
         """
+        if self._scope is None:
+            self.locate()
         return self._scope
 
 
+    def locate(self, table:Optional[LineTable]=None) -> None:
+        """
+        Calculate scope of snippet, by line table of its document if given.
+
+        It is called by :meth:`scope` if not called before, the picker calls
+        it with the line table shared by all snippets of document.
+        """
+        scope = [float('inf'), -float('inf')]
+        for node in self.nodes():
+            if not node.line:
+                continue # Skip node that have None line, I dont know why :'(
+            start, end = table.scope(node) if table else (line_of_start(node),
+                                                          line_of_end(node))
+            scope[0] = min(scope[0], start)
+            scope[1] = max(scope[1], end)
+        self._scope = scope
+
+
     def text(self) -> List[str]:
         """Return the original reStructuredText text of snippet."""
         return read_partial_file(self.file(), self.scope())
@@ -109,9 +143,19 @@ class Snippet(ABC):
         return self._refid
 
 
-    def __getstate__(self) -> Dict[str,Any]:
-        """Implement :py:meth:`pickle.object.__getstate__`."""
-        return self.__dict__.copy()
+    def record(self) -> Record:
+        """
+        Return a :class:`Record` of snippet. Snippet holds docutils nodes and
+        only exists at build time, record is what we persist.
+        """
+        return Record(kind=self.kind(),
+                      file=self.file(),
+                      scope=tuple(self.scope()),
+                      refid=self.refid(),
+                      language=self.language(),
+                      excerpt=self.excerpt(),
+                      description=self.astext(),
+                      code=self.code())
 
 
 @dataclass
@@ -137,20 +181,16 @@ class Headline(Snippet):
         return 'd'
 
 
+    def astext(self) -> str:
+        return '\n'.join(x.astext() for x in self.nodes())
+
+
     def text(self) -> List[str]:
         """
         Headline represents a reStructuredText document,
         so return the whole source file.
         """
-        with open(self.file()) as f:
-            return f.read().splitlines()
-
-
-    def __getstate__(self) -> Dict[str,Any]:
-        self.title = self.title.deepcopy()
-        if self.subtitle:
-            self.subtitle = self.subtitle.deepcopy()
-        return super().__getstate__()
+        return read_file(self.file())
 
 
 @dataclass
@@ -173,15 +213,83 @@ class Code(Snippet):
         return 'c'
 
 
+    def astext(self) -> str:
+        return '\n'.join(x.astext() for x in self.description)
+
+
     def language(self) -> str:
         """Return the (programing) language that appears in code."""
         return self.block['language']
 
 
-    def __getstate__(self) -> Dict[str,Any]:
-        self.description = [x.deepcopy() for x in self.description]
-        self.block = self.block.deepcopy()
-        return super().__getstate__()
+    def code(self) -> str:
+        return self.block.astext()
+
+
+class Record(object):
+    """
+    Record is a lightweight, picklable form of :class:`Snippet` which only
+    consists of plain strings and integers, it is what stored in snippet cache.
+
+    It provides the same interfaces as snippet, except :meth:`Snippet.nodes`.
+    """
+    __slots__ = ('_kind', '_file', '_scope', '_refid', '_language',
+                 '_excerpt', '_description', '_code')
+
+    def __init__(self, kind:str, file:str, scope:Tuple[int,int],
+                 refid:Optional[str], language:Optional[str], excerpt:str,
+                 description:str, code:Optional[str]) -> None:
+        self._kind = kind
+        self._file = file
+        self._scope = scope
+        self._refid = refid
+        self._language = language
+        self._excerpt = excerpt
+        self._description = description
+        self._code = code
+
+
+    def kind(self) -> str:
+        return self._kind
+
+
+    def file(self) -> str:
+        return self._file
+
+
+    def scope(self) -> Tuple[int,int]:
+        return self._scope
+
+
+    def refid(self) -> Optional[str]:
+        return self._refid
+
+
+    def language(self) -> Optional[str]:
+        return self._language
+
+
+    def excerpt(self) -> str:
+        return self._excerpt
+
+
+    def astext(self) -> str:
+        return self._description
+
+
+    def code(self) -> Optional[str]:
+        return self._code
+
+
+    def text(self) -> List[str]:
+        if self._kind == Headline.kind():
+            return read_file(self._file)
+        return read_partial_file(self._file, self._scope)
+
+
+def read_file(filename:str) -> List[str]:
+    with open(filename) as f:
+        return f.read().splitlines()
 
 
 def read_partial_file(filename:str, scope:Tuple[int,Optional[int]]) -> List[str]:
@@ -195,6 +303,8 @@ def read_partial_file(filename:str, scope:Tuple[int,Optional[int]]) -> List[str]
 
 
 def line_of_start(node:nodes.Node) -> int:
+    from docutils import nodes
+
     assert node.line
     if isinstance(node, nodes.title):
         if isinstance(node.parent.parent, nodes.document):
@@ -216,7 +326,8 @@ def line_of_start(node:nodes.Node) -> int:
 def line_of_end(node:nodes.Node) -> Optional[int]:
     next_node = node.next_node(descend=False, siblings=True, ascend=True)
     while next_node:
-        if next_node.line:
+        # Nodes of other source are skipped
+        if next_node.line and next_node.source == node.source:
             return line_of_start(next_node)
         next_node = next_node.next_node(
             # Some nodes' line attr is always None, but their children has
@@ -226,7 +337,84 @@ def line_of_end(node:nodes.Node) -> Optional[int]:
             # of next node
             ascend=True, siblings=True)
     # No line found, return the max line of source file
-    if node.source:
-        with open(node.source) as f:
-            return sum(1 for line in f)
-    raise AttributeError('None source attr of node %s' % node)
+    return line_count(node)
+
+
+# Source file -> number of lines, cleared when a build starts
+_line_counts:Dict[str,int] = {}
+
+def line_count(node:nodes.Node) -> int:
+    """
+    Return number of lines of source file of node, 0 is returned if the
+    source is not a readable file (for example, docstring pulled by autodoc
+    has source like ``mymod.py:docstring of mymod.foo``).
+    """
+    if not node.source:
+        raise AttributeError('None source attr of node %s' % node)
+    if node.source not in _line_counts:
+        try:
+            with open(node.source) as f:
+                _line_counts[node.source] = sum(1 for line in f)
+        except OSError:
+            _line_counts[node.source] = 0
+    return _line_counts[node.source]
+
+
+def clear_line_counts() -> None:
+    """Forget cached number of lines of source files."""
+    _line_counts.clear()
+
+
+class LineTable(object):
+    """
+    Start and end lines of nodes of a doctree, computed in one pass rather
+    than by :func:`line_of_start` and :func:`line_of_end` for every node.
+    """
+    # Nodes in document order, hold them so their ids are not reused
+    _nodes:List[nodes.Node]
+    # id(node) -> (start line, end line or None)
+    _scopes:Dict[int,Tuple[int,Optional[int]]]
+
+    def __init__(self, doctree:nodes.document) -> None:
+        from docutils import nodes
+
+        self._nodes = []
+        # Index of the first node after subtree of each node
+        skips = []
+        def walk(node:nodes.Node) -> None:
+            i = len(self._nodes)
+            self._nodes.append(node)
+            skips.append(None)
+            if isinstance(node, nodes.Element):
+                for child in node.children:
+                    walk(child)
+            skips[i] = len(self._nodes)
+        walk(doctree)
+
+        # Source -> indexes and start lines of nodes which have line, nodes
+        # of different sources (for example, docstring pulled by autodoc)
+        # are interleaved in doctree
+        indexes, starts = {}, {}
+        for i, node in enumerate(self._nodes):
+            if node.line:
+                indexes.setdefault(node.source, []).append(i)
+                starts.setdefault(node.source, []).append(line_of_start(node))
+
+        self._scopes = {}
+        for source, nodes_ in indexes.items():
+            for j, i in enumerate(nodes_):
+                # End line is start line of the first node of the same
+                # source after subtree of node
+                k = bisect_left(nodes_, skips[i], j + 1)
+                end = starts[source][k] if k < len(nodes_) else None
+                self._scopes[id(self._nodes[i])] = (starts[source][j], end)
+
+
+    def scope(self, node:nodes.Node) -> Tuple[int,int]:
+        """Return start and end line of node, node must have line."""
+        if id(node) not in self._scopes:
+            # Node is added after table is built
+            return (line_of_start(node), line_of_end(node))
+        start, end = self._scopes[id(node)]
+        return (start, end if end is not None else line_count(node))
+
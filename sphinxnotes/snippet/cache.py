@@ -6,97 +6,1244 @@
 """
 
 from __future__ import annotations
-from typing import List, Tuple, Dict, Optional
+from typing import List, Tuple, Dict, Optional, Iterator, Set, Iterable
 from dataclasses import dataclass
+import os
+from os import path
+from math import log
+from collections import Counter
+from hashlib import sha1
+from urllib.parse import quote
+import json
+import sqlite3
+import zlib
 
-from . import Snippet
-from .utils.pdict import PDict
+from . import Record, Headline
+from .keyword import Extractor
+from .utils.pdict import PDict, clear_outdated
+from .utils.titlepath import TitlePath
+from .utils import indexfile, trigram, codeindex, minhash, lineindex
 
 @dataclass(frozen=True)
 class Item(object):
-    """ Item of snippet cache. """
-    snippet:Snippet
-    titlepath:List[str]
+    """
+    Item of snippet cache.
+
+    Keywords are candidates of keywords in order of occurrence, a keyword
+    may occurs many times. They are ranked when the item is indexed, see
+    :meth:`Cache.rank_keywords`.
+
+    Title paths of items of the same document share nodes, so they are
+    pickled once.
+    """
+    snippet:Record
+    titlepath:TitlePath
     keywords:List[str]
 
 
 DocID = Tuple[str,str] # (project, docname)
-IndexID = str # UUID
+IndexID = str # Hex digest of (project, docname, snippet identity)
 Index = Tuple[str,str,List[str],List[str]] # (kind, excerpt, titlepath, keywords)
+DocInfo = Tuple[str,List[str]] # (fingerprint, docpath)
+Snapshot = Tuple[str,List[str]] # (content hash, lines of text)
+
+# Indexes of snippets, updated incrementally when document is dumped or purged.
+# ``pos`` is the position of snippet in document's item list; titlepath and
+# keywords are JSON-encoded list of string.
+#
+# ``docs`` records fingerprint of document's source and the title path of
+# document (JSON-encoded) when its items were picked.
+#
+# ``postings`` is an inverted index of terms of snippet, terms come from
+# keyword candidates and title path, length of the snippet (total number of
+# terms) is stored with each posting. ``df`` records number of snippets that
+# contain the term. They are used for ranking keywords by TF-IDF and
+# ranking search results by BM25.
+#
+# ``trigrams`` is an index of trigrams of excerpt and titles of snippet, for
+# substring matching, see :mod:`sphinxnotes.snippet.utils.trigram`.
+#
+# ``code_postings`` is an optional positional index of code of snippet, see
+# :mod:`sphinxnotes.snippet.utils.codeindex`.
+#
+# ``signatures`` holds MinHash signatures of keyword candidates and code of
+# snippets, ``bands`` holds their LSH buckets, for finding related
+# snippets, see :mod:`sphinxnotes.snippet.utils.minhash`.
+#
+# ``keywords`` records number of indexes that have the keyword.
+# ``completions`` maps keys to keywords, the keys of a keyword are itself,
+# its pinyin and pinyin initials (for Chinese keyword). Keys are sorted by
+# the B-tree of primary key, so it works as a prefix trie.
+#
+# ``lines`` holds line-offset indexes of source files of snippets of
+# document, for reading text of snippet without scanning the source, see
+# :mod:`sphinxnotes.snippet.utils.lineindex`.
+#
+# ``stats`` is a single row of statistic of project, updated by deltas of
+# dumped documents, ``num_docs`` is the number of documents that have
+# snippets and ``num_terms`` is the total length of snippets.
+#
+# ``snapshots`` records content hash of text of snippet when it is dumped,
+# ``snapshot_texts`` holds the zlib-compressed texts, identical texts are
+# stored once, ``n`` is the number of snippets refer to the text.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS indexes (
+    id TEXT PRIMARY KEY,
+    project TEXT NOT NULL,
+    docname TEXT NOT NULL,
+    pos INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    excerpt TEXT NOT NULL,
+    titlepath TEXT NOT NULL,
+    keywords TEXT NOT NULL,
+    length INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS indexes_by_doc ON indexes (project, docname);
+
+CREATE TABLE IF NOT EXISTS docs (
+    docname TEXT PRIMARY KEY,
+    fingerprint TEXT NOT NULL,
+    docpath TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS postings (
+    term TEXT NOT NULL,
+    id TEXT NOT NULL,
+    tf INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    PRIMARY KEY (term, id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS postings_by_id ON postings (id);
+
+CREATE TABLE IF NOT EXISTS df (
+    term TEXT PRIMARY KEY,
+    n INTEGER NOT NULL
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS trigrams (
+    gram TEXT NOT NULL,
+    id TEXT NOT NULL,
+    PRIMARY KEY (gram, id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS trigrams_by_id ON trigrams (id);
+
+CREATE TABLE IF NOT EXISTS code_postings (
+    token TEXT NOT NULL,
+    id TEXT NOT NULL,
+    positions BLOB NOT NULL,
+    PRIMARY KEY (token, id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS code_postings_by_id ON code_postings (id);
+
+CREATE TABLE IF NOT EXISTS signatures (
+    id TEXT PRIMARY KEY,
+    signature BLOB NOT NULL
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS bands (
+    band INTEGER NOT NULL,
+    bucket INTEGER NOT NULL,
+    id TEXT NOT NULL,
+    PRIMARY KEY (band, bucket, id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS bands_by_id ON bands (id);
+
+CREATE TABLE IF NOT EXISTS keywords (
+    keyword TEXT PRIMARY KEY,
+    n INTEGER NOT NULL
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS completions (
+    key TEXT NOT NULL,
+    keyword TEXT NOT NULL,
+    PRIMARY KEY (key, keyword)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS lines (
+    docname TEXT NOT NULL,
+    file TEXT NOT NULL,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL,
+    offsets BLOB NOT NULL,
+    PRIMARY KEY (docname, file)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS snapshots (
+    id TEXT PRIMARY KEY,
+    hash TEXT NOT NULL
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS snapshot_texts (
+    hash TEXT PRIMARY KEY,
+    text BLOB NOT NULL,
+    n INTEGER NOT NULL
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS stats (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    num_docs INTEGER NOT NULL,
+    num_snippets INTEGER NOT NULL,
+    num_terms INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS changes (
+    id TEXT PRIMARY KEY,
+    project TEXT NOT NULL,
+    docname TEXT NOT NULL,
+    change TEXT NOT NULL
+);
+"""
+
+# Manifest of cache, one row per shard (project), it is a copy of ``stats``
+# of shards
+MANIFEST_SCHEMA = """
+CREATE TABLE IF NOT EXISTS shards (
+    project TEXT PRIMARY KEY,
+    num_docs INTEGER NOT NULL,
+    num_snippets INTEGER NOT NULL,
+    num_terms INTEGER NOT NULL
+);
+"""
+MANIFEST_VERSION = 1
+
+# Parameters of BM25
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Kinds of index change, recorded in ``changes`` table
+ADDED = 'added'
+MODIFIED = 'modified'
+REMOVED = 'removed'
+
+def encode_text(lines:List[str]) -> bytes:
+    """Encode lines of text of snippet for hashing and snapshot."""
+    return ''.join(line + '\n' for line in lines).encode()
+
+
+def decode_text(data:bytes) -> List[str]:
+    """Reverse of :func:`encode_text`."""
+    return data.decode().split('\n')[:-1]
+
 
 class Cache(PDict):
-    """A DocID -> List[Item] Cache."""
-    indexes:Dict[IndexID,Index]
-    index_id_to_doc_id:Dict[IndexID,Tuple[DocID,int]]
-    doc_id_to_index_ids:Dict[DocID,List[IndexID]]
-    num_snippets_by_project:Dict[str,int]
-    num_snippets_by_docid:Dict[DocID,int]
+    """
+    A DocID -> List[Item] Cache.
+
+    Cache is sharded by project, each project has its own database and index
+    files, a small manifest records projects and their statistic, so that
+    commands scoped to some projects only open the shards they need.
+
+    Keywords of snippets are ranked by TF-IDF against snippets of the same
+    project. Document frequencies are updated incrementally before any
+    document is dumped, keywords of a document are ranked again only when
+    the document is dumped.
+    """
+
+    schema_version = 12
+    # Number of keywords of a index
+    num_keywords:int = 10
+    # Whether to index code of snippets
+    index_code:bool = False
+    # Extractor for tokenizing titles and search queries
+    extractor:Extractor
+
+    # Projects whose changes have been reset in current dump
+    _changed_projects:Set[str]
+    # Number of snippets of projects after current dump
+    _num_snippets:Dict[str,int]
+    # Statistic of projects (see ``stats`` table), updated during dump
+    _stats:Dict[str,List[int]]
+    # Documents whose index files need to be rewritten in current dump
+    _index_docs:Dict[str,Set[str]]
+    # Projects whose index files need to be rebuilt
+    _rebuild_index:Set[str]
+    # Terms of titles in title path
+    _title_terms:Dict[str,List[str]]
+    # Information of documents that need to be written with their items
+    _doc_infos:Dict[DocID,DocInfo]
+    # Connection to manifest database, opened on demand
+    _manifest:Optional[sqlite3.Connection]
 
     def __init__(self, dirname:str) -> None:
-        self.indexes = {}
-        self.index_id_to_doc_id = {}
-        self.doc_id_to_index_ids = {}
-        self.num_snippets_by_project= {}
-        self.num_snippets_by_docid = {}
+        self._changed_projects = set()
+        self._num_snippets = {}
+        self._stats = {}
+        self._index_docs = {}
+        self._rebuild_index = set()
+        self._title_terms = {}
+        self._doc_infos = {}
+        self.extractor = Extractor()
+        self._manifest = None
         super().__init__(dirname)
 
 
+    def schema(self) -> str:
+        """Overwrite PDict.schema."""
+        return super().schema() + SCHEMA
+
+
+    def manifest(self) -> sqlite3.Connection:
+        """Return connection to manifest database."""
+        if self._manifest:
+            return self._manifest
+        if not path.exists(self.dirname):
+            os.makedirs(self.dirname)
+        self._manifest = sqlite3.connect(path.join(self.dirname, 'manifest.db'),
+                                         isolation_level=None,
+                                         timeout=self.lock_timeout)
+        clear_outdated(self._manifest, MANIFEST_VERSION)
+        self._manifest.executescript(MANIFEST_SCHEMA)
+        return self._manifest
+
+
+    def shard(self, key:DocID) -> str:
+        """Overwrite PDict.shard."""
+        return key[0]
+
+
+    def shards(self) -> List[str]:
+        """Overwrite PDict.shards."""
+        return [row[0] for row in self.manifest().execute('SELECT project FROM shards')]
+
+
+    def dbfile(self, shard:str) -> str:
+        """Overwrite PDict.dbfile."""
+        return path.join(self.dirname, 'shards', quote(shard, safe='') + '.db')
+
+
+    def pre_dump(self, shard:str, orphan_keys:List[DocID], dirty_keys:List[DocID]) -> None:
+        """
+        Overwrite PDict.pre_dump.
+
+        Term statistic of all documents is updated before they are dumped,
+        so keywords are ranked against the whole project.
+        """
+        conn = self.conn(shard)
+        row = conn.execute('SELECT num_docs, num_snippets, num_terms FROM stats').fetchone()
+        if not row:
+            # Database is newly created, index files of project are stale
+            row = (0, 0, 0)
+            conn.execute('INSERT INTO stats VALUES (0, ?, ?, ?)', row)
+            self._rebuild_index.add(shard)
+        self._stats[shard] = list(row)
+        self._index_docs.setdefault(shard, set())
+
+        num_snippets = row[1]
+        for key in orphan_keys + dirty_keys:
+            old_ids = [row[0] for row in conn.execute(
+                'SELECT id FROM indexes WHERE project = ? AND docname = ?', key)]
+            items = self._dirty_items.get(key, [])
+            tfs = {index_id: Counter(self.terms(item))
+                   for index_id, item in zip(self.gen_index_ids(key, items), items)}
+            self.update_terms(shard, old_ids, tfs)
+            num_snippets += len(tfs) - len(old_ids)
+        self._num_snippets[shard] = num_snippets
+
+
+    def pre_commit(self, shard:str) -> None:
+        """
+        Overwrite PDict.pre_commit.
+
+        Index files and manifest are updated while holding the write lock of
+        shard, so they always reflect the latest commit even if several
+        builds dump concurrently. Only index files of dumped documents are
+        rewritten.
+        """
+        conn = self.conn(shard)
+        docnames = self._index_docs.pop(shard)
+        directory = indexfile.dirname(self.dirname, shard)
+        if shard in self._rebuild_index or not path.isdir(directory):
+            indexfile.clear(directory)
+            docnames = [row[0] for row in conn.execute('SELECT DISTINCT docname FROM indexes')]
+            self._rebuild_index.discard(shard)
+        for docname in docnames:
+            filename = indexfile.filename(self.dirname, shard, docname)
+            rows = [(index_id, (kind, excerpt, titlepath, self.listed_keywords(keywords)))
+                    for index_id, (kind, excerpt, titlepath, keywords)
+                    in self.indexes(shard, docname)]
+            if rows:
+                indexfile.dump(filename, rows)
+            else:
+                indexfile.remove(filename)
+
+        stats = self._stats.pop(shard)
+        conn.execute('UPDATE stats SET num_docs = ?, num_snippets = ?, num_terms = ?', stats)
+        self.manifest().execute('INSERT OR REPLACE INTO shards VALUES (?, ?, ?, ?)',
+                                (shard, *stats))
+        self._changed_projects.discard(shard)
+        del self._num_snippets[shard]
+
+
     def post_dump(self, key:DocID, items:List[Item]) -> None:
-        """Overwrite PDict.post_dump."""
-
-        # Remove old indexes and index IDs if exists
-        for old_index_id in self.doc_id_to_index_ids.setdefault(key, []):
-            del self.index_id_to_doc_id[old_index_id]
-            del self.indexes[old_index_id]
-
-        # Add new index to every where
-        for i, item in enumerate(items):
-            index_id = self.gen_index_id()
-            self.indexes[index_id] = (item.snippet.kind(),
-                                      item.snippet.excerpt(),
-                                      item.titlepath,
-                                      item.keywords)
-            self.index_id_to_doc_id[index_id] = (key, i)
-            self.doc_id_to_index_ids[key].append(index_id)
-
-        # Update statistic
-        if key[0] not in self.num_snippets_by_project:
-            self.num_snippets_by_project[key[0]] = 0
-        self.num_snippets_by_project[key[0]] += len(items)
-        if key not in self.num_snippets_by_docid:
-            self.num_snippets_by_docid[key] = 0
-        self.num_snippets_by_docid[key] += len(items)
+        """
+        Overwrite PDict.post_dump.
+
+        Index IDs are derived from snippet identity, so only indexes that
+        actually changed are touched.
+        """
+        conn = self.conn(key[0])
+
+        old_indexes = {row[0]: row[1:] for row in conn.execute(
+            'SELECT id, pos, kind, excerpt, titlepath, keywords, length FROM indexes '
+            'WHERE project = ? AND docname = ?', key)}
+        index_ids = self.gen_index_ids(key, items)
+        tfs = [Counter(item.keywords) for item in items]
+        dfs = self.dfs(key[0], {term for tf in tfs for term in tf})
+
+        new_indexes = {}
+        for index_id, (i, item) in zip(index_ids, enumerate(items)):
+            keywords = self.rank_keywords(tfs[i], dfs, self._num_snippets[key[0]])
+            new_indexes[index_id] = (i,
+                                     item.snippet.kind(),
+                                     item.snippet.excerpt(),
+                                     json.dumps(list(item.titlepath)),
+                                     json.dumps(keywords),
+                                     len(self.terms(item)))
+
+        added, modified, removed = [], [], []
+        for index_id, index in new_indexes.items():
+            if index_id not in old_indexes:
+                added.append(index_id)
+            elif index != old_indexes[index_id]:
+                modified.append(index_id)
+        for index_id in old_indexes:
+            if index_id not in new_indexes:
+                removed.append(index_id)
+
+        conn.executemany('DELETE FROM indexes WHERE id = ?',
+                         [(index_id,) for index_id in removed])
+        conn.executemany('INSERT OR REPLACE INTO indexes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                         [(index_id, key[0], key[1], *new_indexes[index_id])
+                          for index_id in added + modified])
+
+        # Excerpt and title path are not always changed with index
+        self.update_trigrams(key[0], removed, {
+            index_id: (items[new_indexes[index_id][0]].snippet.excerpt(),
+                       items[new_indexes[index_id][0]].titlepath)
+            for index_id in added + modified
+            if index_id not in old_indexes or new_indexes[index_id][2:4] != old_indexes[index_id][2:4]})
+        # Code is not a part of index, rewrite all
+        self.update_code_postings(key[0], list(old_indexes), {
+            index_id: (item.snippet.code(), item.snippet.language())
+            for index_id, item in zip(index_ids, items) if item.snippet.code()})
+        self.update_signatures(key[0], list(old_indexes), dict(zip(index_ids, items)))
+        self.update_lines(key, items)
+        self.update_snapshots(key[0], list(old_indexes),
+                              self.snapshot_texts(key, dict(zip(index_ids, items))))
+
+        self.record_changes(key, ADDED, added)
+        self.record_changes(key, MODIFIED, modified)
+        self.record_changes(key, REMOVED, removed)
+        self.update_stats(key, list(old_indexes.values()), list(new_indexes.values()))
+
+        delta = Counter()
+        for index_id in modified + removed:
+            delta.subtract(json.loads(old_indexes[index_id][4]))
+        for index_id in added + modified:
+            delta.update(json.loads(new_indexes[index_id][4]))
+        self.update_keywords(key[0], delta)
+
+        # Items without information may be picked from a different source,
+        # forget the stale fingerprint
+        if key in self._doc_infos:
+            fingerprint, docpath = self._doc_infos.pop(key)
+            conn.execute('INSERT OR REPLACE INTO docs VALUES (?, ?, ?)',
+                         (key[1], fingerprint, json.dumps(docpath)))
+        else:
+            conn.execute('DELETE FROM docs WHERE docname = ?', (key[1],))
 
 
     def post_purge(self, key:DocID, items:List[Item]) -> None:
         """Overwrite PDict.post_purge."""
+        conn = self.conn(key[0])
 
         # Purge indexes
-        for index_id in self.doc_id_to_index_ids.pop(key):
-            del self.index_id_to_doc_id[index_id]
-            del self.indexes[index_id]
+        removed = []
+        old_indexes = []
+        delta = Counter()
+        for row in conn.execute('SELECT id, pos, kind, excerpt, titlepath, keywords, length '
+                                'FROM indexes WHERE project = ? AND docname = ?', key):
+            removed.append(row[0])
+            old_indexes.append(row[1:])
+            delta.subtract(json.loads(row[5]))
+        self.update_trigrams(key[0], removed, {})
+        self.update_code_postings(key[0], removed, {})
+        self.update_signatures(key[0], removed, {})
+        self.update_keywords(key[0], delta)
+        self.update_lines(key, [])
+        self.update_snapshots(key[0], removed, {})
+        conn.execute('DELETE FROM indexes WHERE project = ? AND docname = ?', key)
+        conn.execute('DELETE FROM docs WHERE docname = ?', (key[1],))
+        self._doc_infos.pop(key, None)
+
+        self.record_changes(key, REMOVED, removed)
+        self.update_stats(key, old_indexes, [])
+
+
+    def update_stats(self, key:DocID, old_indexes:List[tuple], new_indexes:List[tuple]) -> None:
+        """
+        Update statistic of project by old and new indexes of document (rows
+        of ``indexes`` table without id), and mark its index file dirty.
+        """
+        stats = self._stats[key[0]]
+        stats[0] += bool(new_indexes) - bool(old_indexes)
+        stats[1] += len(new_indexes) - len(old_indexes)
+        stats[2] += sum(x[5] for x in new_indexes) - sum(x[5] for x in old_indexes)
+        self._index_docs[key[0]].add(key[1])
+
+
+    def update_terms(self, project:str, old_ids:List[IndexID],
+                     tfs:Dict[IndexID,Counter]) -> None:
+        """
+        Replace postings of old indexes with the new ones, and update
+        document frequencies accordingly.
+        """
+        conn = self.conn(project)
+        old_tfs = {}
+        for index_id in old_ids:
+            old_tfs[index_id] = dict(conn.execute('SELECT term, tf FROM postings WHERE id = ?',
+                                                  (index_id,)))
+        delta = Counter()
+        for index_id in old_tfs.keys() | tfs.keys():
+            old_tf = old_tfs.get(index_id, {})
+            new_tf = tfs.get(index_id, {})
+            if old_tf == new_tf:
+                continue
+            # Length of snippet is changed, rewrite all postings
+            length = sum(new_tf.values())
+            conn.execute('DELETE FROM postings WHERE id = ?', (index_id,))
+            conn.executemany('INSERT INTO postings VALUES (?, ?, ?, ?)',
+                             [(term, index_id, n, length) for term, n in new_tf.items()])
+            delta.subtract(old_tf.keys() - new_tf.keys())
+            delta.update(new_tf.keys() - old_tf.keys())
+        for term, n in delta.items():
+            if n == 0:
+                continue
+            conn.execute('INSERT INTO df VALUES (?, ?) ON CONFLICT (term) '
+                         'DO UPDATE SET n = n + excluded.n', (term, n))
+        conn.execute('DELETE FROM df WHERE n <= 0')
+
+
+    def update_trigrams(self, project:str, removed:List[IndexID],
+                        texts:Dict[IndexID,Tuple[str,List[str]]]) -> None:
+        """
+        Remove trigrams of removed indexes, and replace trigrams of indexes
+        with given (excerpt, titlepath).
+        """
+        conn = self.conn(project)
+        conn.executemany('DELETE FROM trigrams WHERE id = ?',
+                         [(index_id,) for index_id in removed + list(texts)])
+        for index_id, (excerpt, titlepath) in texts.items():
+            conn.executemany('INSERT INTO trigrams VALUES (?, ?)',
+                             [(gram, index_id) for gram in trigram.trigrams([excerpt, *titlepath])])
+
+
+    def update_code_postings(self, project:str, removed:List[IndexID],
+                             codes:Dict[IndexID,Tuple[str,Optional[str]]]) -> None:
+        """
+        Remove code postings of removed indexes, and replace code postings
+        of indexes with given (code, language) if code indexing is enabled.
+        """
+        conn = self.conn(project)
+        conn.executemany('DELETE FROM code_postings WHERE id = ?',
+                         [(index_id,) for index_id in removed + list(codes)])
+        if not self.index_code:
+            return
+        for index_id, (code, language) in codes.items():
+            conn.executemany('INSERT INTO code_postings VALUES (?, ?, ?)',
+                             [(token, index_id, codeindex.encode_positions(positions))
+                              for token, positions in codeindex.postings(code, language).items()])
+
+
+    def update_signatures(self, project:str, removed:List[IndexID],
+                          items:Dict[IndexID,Item]) -> None:
+        """
+        Remove MinHash signatures of removed indexes, and replace signatures
+        of indexes of given items.
+        """
+        conn = self.conn(project)
+        for table in ['signatures', 'bands']:
+            conn.executemany('DELETE FROM %s WHERE id = ?' % table,
+                             [(index_id,) for index_id in removed + list(items)])
+        for index_id, item in items.items():
+            sig = minhash.signature(self.shingles(item))
+            if not sig:
+                continue
+            conn.execute('INSERT INTO signatures VALUES (?, ?)', (index_id, sig))
+            conn.executemany('INSERT INTO bands VALUES (?, ?, ?)',
+                             [(band, bucket, index_id)
+                              for band, bucket in enumerate(minhash.buckets(sig))])
+
+
+    def shingles(self, item:Item) -> List[str]:
+        """Return shingles of item for finding related items."""
+        shingles = list(item.keywords)
+        if item.snippet.code():
+            shingles += [x[0] for x in codeindex.tokenize(item.snippet.code(),
+                                                           item.snippet.language())]
+        return shingles
+
+
+    def update_lines(self, key:DocID, items:List[Item]) -> None:
+        """Replace line-offset indexes of source files of document."""
+        conn = self.conn(key[0])
+        conn.execute('DELETE FROM lines WHERE docname = ?', (key[1],))
+        for filename in {item.snippet.file() for item in items}:
+            try:
+                index = lineindex.build(filename)
+            except OSError:
+                continue
+            conn.execute('INSERT INTO lines VALUES (?, ?, ?, ?, ?)',
+                         (key[1], filename, *index))
 
-        # Update statistic
-        self.num_snippets_by_project[key[0]] -= len(items)
-        if self.num_snippets_by_project[key[0]] == 0:
-            del self.num_snippets_by_project[key[0]]
-        self.num_snippets_by_docid[key] -= len(items)
-        if self.num_snippets_by_docid[key] == 0:
-            del self.num_snippets_by_docid[key]
 
+    def update_snapshots(self, project:str, removed:List[IndexID],
+                         texts:Dict[IndexID,List[str]]) -> None:
+        """
+        Remove text snapshots of removed indexes, and replace snapshots of
+        indexes with given texts.
+        """
+        conn = self.conn(project)
+        hashes = set()
+        for index_id in removed + list(texts):
+            row = conn.execute('SELECT hash FROM snapshots WHERE id = ?', (index_id,)).fetchone()
+            if not row:
+                continue
+            conn.execute('DELETE FROM snapshots WHERE id = ?', (index_id,))
+            conn.execute('UPDATE snapshot_texts SET n = n - 1 WHERE hash = ?', row)
+            hashes.add(row[0])
+        for index_id, lines in texts.items():
+            data = encode_text(lines)
+            digest = sha1(data).hexdigest()
+            conn.execute('INSERT INTO snapshots VALUES (?, ?)', (index_id, digest))
+            if not conn.execute('UPDATE snapshot_texts SET n = n + 1 WHERE hash = ?',
+                                (digest,)).rowcount:
+                conn.execute('INSERT INTO snapshot_texts VALUES (?, ?, 1)',
+                             (digest, zlib.compress(data)))
+        conn.executemany('DELETE FROM snapshot_texts WHERE hash = ? AND n <= 0',
+                         [(x,) for x in hashes])
 
-    def get_by_index_id(self, key:IndexID) -> Optional[Item]:
+
+    def snapshot_texts(self, key:DocID, items:Dict[IndexID,Item]) -> Dict[IndexID,List[str]]:
+        """
+        Return texts of snippets of document to be snapshotted. Snapshot is
+        best-effort, snippets whose source can not be read have no snapshot
+        (see :meth:`texts`).
+        """
+        return self.texts({index_id: (key, item) for index_id, item in items.items()})
+
+
+    def update_keywords(self, project:str, delta:Counter) -> None:
+        """
+        Update number of indexes of keywords, keys of completion are added
+        for new keywords and removed for vanished keywords.
+        """
+        conn = self.conn(project)
+        for keyword, n in delta.items():
+            if n == 0:
+                continue
+            conn.execute('INSERT INTO keywords VALUES (?, ?) ON CONFLICT (keyword) '
+                         'DO UPDATE SET n = n + excluded.n', (keyword, n))
+            n, = conn.execute('SELECT n FROM keywords WHERE keyword = ?', (keyword,)).fetchone()
+            if n <= 0:
+                conn.execute('DELETE FROM keywords WHERE keyword = ?', (keyword,))
+                conn.execute('DELETE FROM completions WHERE keyword = ?', (keyword,))
+            elif n == delta[keyword]:
+                # Keyword is new
+                conn.executemany('INSERT OR IGNORE INTO completions VALUES (?, ?)',
+                                 [(k, keyword) for k in self.completion_keys(keyword)])
+
+
+    def listed_keywords(self, keywords:List[str]) -> List[str]:
+        """
+        Return keywords written to index file, pinyin initials of Chinese
+        keywords are appended, so that fuzzy finders working on output of
+        ``snippet list`` (see integrations) can find them by pinyin.
+        """
+        initials = []
+        for keyword in keywords:
+            pinyin = self.extractor.pinyin(keyword)
+            if pinyin:
+                initials.append(''.join(x[0] for x in pinyin if x))
+        return keywords + initials
+
+
+    def completion_keys(self, keyword:str) -> Set[str]:
+        """Return keys that can be completed to keyword."""
+        keys = {keyword}
+        pinyin = self.extractor.pinyin(keyword)
+        if pinyin:
+            keys.add(''.join(pinyin))
+            keys.add(''.join(x[0] for x in pinyin if x))
+        return keys
+
+
+    def terms(self, item:Item) -> List[str]:
+        """Return terms of item, which are indexed for searching."""
+        terms = list(item.keywords)
+        for title in item.titlepath:
+            if title not in self._title_terms:
+                self._title_terms[title] = self.extractor.extract(title)
+            terms += self._title_terms[title]
+        return terms
+
+
+    def dfs(self, project:str, terms:Iterable[str]) -> Dict[str,int]:
+        """Return document frequencies of given terms."""
+        conn = self.conn(project)
+        terms = list(terms)
+        dfs = {}
+        # SQLite limits number of host parameters
+        for i in range(0, len(terms), 500):
+            chunk = terms[i:i+500]
+            dfs.update(conn.execute('SELECT term, n FROM df WHERE term IN (%s)' %
+                                    ','.join('?' * len(chunk)), chunk))
+        return dfs
+
+
+    def rank_keywords(self, tf:Counter, dfs:Dict[str,int], num_snippets:int) -> List[str]:
+        """
+        Return top keywords ranked by TF-IDF, terms with same score keep their
+        order of occurrence.
+        """
+        def score(term:str) -> float:
+            df = dfs.get(term, 1)
+            idf = log((num_snippets - df + 0.5) / (df + 0.5) + 1)
+            return (1 + log(tf[term])) * idf
+        return sorted(tf, key=score, reverse=True)[:self.num_keywords]
+
+
+    def set_doc_info(self, key:DocID, info:DocInfo) -> None:
+        """
+        Set information of document, it is written when the items of
+        document are dumped.
+        """
+        self._doc_infos[key] = info
+
+
+    def doc_infos(self, project:str) -> Dict[str,DocInfo]:
+        """Return a docname -> DocInfo mapping of all documents of project."""
+        if not path.exists(self.dbfile(project)):
+            return {}
+        return {docname: (fingerprint, json.loads(docpath))
+                for docname, fingerprint, docpath in self.conn(project).execute(
+                    'SELECT docname, fingerprint, docpath FROM docs')}
+
+
+    def clear_changes(self, project:str) -> None:
+        """
+        Forget changes of project, it should be called when project is built
+        but nothing is dumped.
+        """
+        if path.exists(self.dbfile(project)):
+            self.conn(project).execute('DELETE FROM changes WHERE project = ?', (project,))
+
+
+    def record_changes(self, key:DocID, change:str, index_ids:List[IndexID]) -> None:
+        """
+        Record changes of indexes, changes of a project are reset when the
+        project is dumped again.
+        """
+        conn = self.conn(key[0])
+        if key[0] not in self._changed_projects:
+            conn.execute('DELETE FROM changes WHERE project = ?', (key[0],))
+            self._changed_projects.add(key[0])
+        conn.executemany('INSERT OR REPLACE INTO changes VALUES (?, ?, ?, ?)',
+                         [(index_id, key[0], key[1], change) for index_id in index_ids])
+
+
+    def indexes(self, project:str, docname:str) -> Iterator[Tuple[IndexID,Index]]:
+        """Iterate over indexes of document."""
+        for row in self.conn(project).execute('SELECT id, kind, excerpt, titlepath, keywords FROM indexes '
+                                              'WHERE project = ? AND docname = ? ORDER BY pos',
+                                              (project, docname)):
+            yield row[0], (row[1], row[2], json.loads(row[3]), json.loads(row[4]))
+
+
+    def get_doc_id(self, key:IndexID,
+                   projects:Optional[List[str]]=None) -> Tuple[Optional[DocID],Optional[int]]:
+        """
+        Return the DocID and item position of given IndexID, only shards of
+        given projects (all projects by default) are looked up.
+        """
+        for project in projects or self.shards():
+            if not path.exists(self.dbfile(project)):
+                continue
+            row = self.conn(project).execute('SELECT docname, pos FROM indexes WHERE id = ?',
+                                             (key,)).fetchone()
+            if row:
+                return ((project, row[0]), row[1])
+        return (None, None)
+
+
+    def get_by_index_id(self, key:IndexID,
+                        projects:Optional[List[str]]=None) -> Optional[Item]:
         """Like get(), but use IndexID as key."""
-        doc_id, item_index = self.index_id_to_doc_id.get(key, (None,None))
+        doc_id, item_index = self.get_doc_id(key, projects)
         if not doc_id:
             return None
+        if doc_id not in self._store:
+            # Shard is not loaded yet
+            self.load([doc_id[0]])
         return self[doc_id][item_index]
 
 
-    def gen_index_id(self) -> str:
-        """Generate unique ID for index."""
-        import uuid
-        return uuid.uuid4().hex[:7]
+    def get_many(self, keys:Iterable[IndexID],
+                 projects:Optional[List[str]]=None) -> Dict[IndexID,Tuple[DocID,Item]]:
+        """
+        Like get_by_index_id(), but look up IndexIDs in batch and return them
+        with their DocIDs, items of a document are loaded once. IndexIDs that
+        do not exist are omitted.
+        """
+        keys = list(set(keys))
+        found = {}
+        for project in projects or self.shards():
+            if not path.exists(self.dbfile(project)):
+                continue
+            missing = [k for k in keys if k not in found]
+            conn = self.conn(project)
+            for i in range(0, len(missing), 500):
+                chunk = missing[i:i+500]
+                for index_id, docname, pos in conn.execute(
+                    'SELECT id, docname, pos FROM indexes WHERE id IN (%s)' % ','.join('?' * len(chunk)),
+                    chunk):
+                    doc_id = (project, docname)
+                    if doc_id not in self._store:
+                        # Shard is not loaded yet
+                        self.load([project])
+                    found[index_id] = (doc_id, self[doc_id][pos])
+        return found
+
+
+    def group_by_file(self, items:Dict[IndexID,Tuple[DocID,Item]]) -> Dict[Tuple[DocID,str],List[IndexID]]:
+        """Group IndexIDs of items by their documents and source files."""
+        groups = {}
+        for index_id, (doc_id, item) in items.items():
+            groups.setdefault((doc_id, item.snippet.file()), []).append(index_id)
+        return groups
+
+
+    def texts(self, items:Dict[IndexID,Tuple[DocID,Item]]) -> Dict[IndexID,List[str]]:
+        """
+        Return texts of snippets of items returned by :meth:`get_many`, read
+        from source files. Snippets are grouped by source file, a file is
+        opened once and read by its line-offset index if the index is up to
+        date. Snippets whose source can not be read (for example, docstring
+        pulled by autodoc) are omitted.
+        """
+        texts = {}
+        for (doc_id, filename), index_ids in self.group_by_file(items).items():
+            snippets = [items[x][1].snippet for x in index_ids]
+            row = self.conn(doc_id[0]).execute('SELECT mtime, size, offsets FROM lines '
+                                               'WHERE docname = ? AND file = ?',
+                                               (doc_id[1], filename)).fetchone()
+            # Headline represents the whole source file
+            scopes = [(1, None) if s.kind() == Headline.kind() else s.scope() for s in snippets]
+            try:
+                lines = lineindex.read(filename, row, scopes) if row else None
+                if lines is None:
+                    lines = [s.text() for s in snippets]
+            except (OSError, UnicodeError):
+                continue
+            texts.update(zip(index_ids, lines))
+        return texts
+
+
+    def snapshots(self, items:Dict[IndexID,Tuple[DocID,Item]]) -> Dict[IndexID,Snapshot]:
+        """
+        Return snapshots of texts of snippets of items returned by
+        :meth:`get_many`, which are taken when the snippets are dumped.
+        Items without snapshot are omitted.
+        """
+        projects = {}
+        for index_id, (doc_id, _) in items.items():
+            projects.setdefault(doc_id[0], []).append(index_id)
+        snapshots = {}
+        for project, index_ids in projects.items():
+            conn = self.conn(project)
+            for i in range(0, len(index_ids), 500):
+                chunk = index_ids[i:i+500]
+                for index_id, digest, data in conn.execute(
+                    'SELECT s.id, s.hash, t.text FROM snapshots AS s '
+                    'JOIN snapshot_texts AS t ON s.hash = t.hash '
+                    'WHERE s.id IN (%s)' % ','.join('?' * len(chunk)), chunk):
+                    snapshots[index_id] = (digest, decode_text(zlib.decompress(data)))
+        return snapshots
+
+
+    def drifted(self, items:Dict[IndexID,Tuple[DocID,Item]],
+                snapshots:Dict[IndexID,Snapshot]) -> Set[IndexID]:
+        """
+        Return IndexIDs of items whose text in source file differs from
+        their snapshot. A source file is only read when its mtime or size
+        changed since dumped, unavailable source files are ignored.
+        """
+        candidates = {}
+        for (doc_id, filename), index_ids in self.group_by_file(items).items():
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            row = self.conn(doc_id[0]).execute('SELECT mtime, size FROM lines '
+                                               'WHERE docname = ? AND file = ?',
+                                               (doc_id[1], filename)).fetchone()
+            if row and (stat.st_mtime, stat.st_size) == tuple(row):
+                continue
+            candidates.update({x: items[x] for x in index_ids if x in snapshots})
+        return {index_id for index_id, lines in self.texts(candidates).items()
+                if sha1(encode_text(lines)).hexdigest() != snapshots[index_id][0]}
+
+
+    def search(self, query:str, projects:Optional[List[str]]=None, kinds:str='*',
+               limit:int=10) -> List[Tuple[IndexID,Index]]:
+        """
+        Return top indexes of given kinds that match query, ranked by BM25.
+        Only shards of given projects (all projects by default) are searched.
+        """
+        projects = [p for p in projects or self.shards() if path.exists(self.dbfile(p))]
+        terms = Counter(self.query_terms(query, projects))
+        wildcard = '*' in kinds
+
+        results = []
+        for project in projects:
+            row = self.manifest().execute('SELECT num_snippets, num_terms FROM shards '
+                                          'WHERE project = ?', (project,)).fetchone()
+            if not row or not row[0]:
+                continue
+            num_snippets, avglen = row[0], row[1] / row[0]
+            conn = self.conn(project)
+            scores = {}
+            for term, qtf in terms.items():
+                postings = conn.execute('SELECT id, tf, length FROM postings WHERE term = ?',
+                                        (term,)).fetchall()
+                df = len(postings)
+                idf = log((num_snippets - df + 0.5) / (df + 0.5) + 1)
+                for index_id, tf, length in postings:
+                    norm = tf + BM25_K1 * (1 - BM25_B + BM25_B * length / avglen)
+                    scores[index_id] = scores.get(index_id, 0) + \
+                            qtf * idf * tf * (BM25_K1 + 1) / norm
+            n = 0
+            for index_id in sorted(scores, key=scores.get, reverse=True):
+                kind, excerpt, titlepath, keywords = conn.execute(
+                    'SELECT kind, excerpt, titlepath, keywords FROM indexes WHERE id = ?',
+                    (index_id,)).fetchone()
+                if not wildcard and kind not in kinds:
+                    continue
+                results.append((scores[index_id], index_id,
+                                (kind, excerpt, json.loads(titlepath), json.loads(keywords))))
+                n += 1
+                if n >= limit:
+                    break
+
+        results.sort(key=lambda x: x[0], reverse=True)
+        return [(index_id, index) for _, index_id, index in results[:limit]]
+
+
+    def match(self, pattern:str, projects:Optional[List[str]]=None, kinds:str='*',
+              limit:int=10, distance:int=0) -> List[Tuple[IndexID,Index]]:
+        """
+        Return indexes of given kinds whose excerpt or title contains pattern,
+        or a substring within given edit distance of pattern. Results are
+        ordered by edit distance and then their position in project.
+
+        Candidates are looked up by trigrams of pattern, short pattern falls
+        back to bigrams or characters (prefixes of trigrams), see
+        :func:`trigram.candidate_grams`.
+        """
+        grams, threshold = trigram.candidate_grams(pattern, distance)
+        wildcard = '*' in kinds
+
+        results = []
+        for project in projects or self.shards():
+            if not path.exists(self.dbfile(project)):
+                continue
+            conn = self.conn(project)
+            if not grams:
+                # Pattern is too short for edit distance, check every index
+                candidates = [row[0] for row in conn.execute('SELECT id FROM indexes')]
+            elif len(next(iter(grams))) == 3:
+                candidates = [row[0] for row in conn.execute(
+                    'SELECT id FROM trigrams WHERE gram IN (%s) GROUP BY id HAVING COUNT(*) >= ?' %
+                    ','.join('?' * len(grams)), (*grams, threshold))]
+            else:
+                # Grams are shorter than trigram, look up trigrams that
+                # start with them
+                counter = Counter()
+                for gram in grams:
+                    counter.update(row[0] for row in conn.execute(
+                        'SELECT DISTINCT id FROM trigrams WHERE gram >= ? AND gram < ?',
+                        (gram, gram + '\U0010ffff')))
+                candidates = [x for x, n in counter.items() if n >= threshold]
+            for i in range(0, len(candidates), 500):
+                chunk = candidates[i:i+500]
+                for row in conn.execute('SELECT id, docname, pos, kind, excerpt, titlepath, keywords '
+                                        'FROM indexes WHERE id IN (%s)' % ','.join('?' * len(chunk)),
+                                        chunk):
+                    index_id, docname, pos, kind, excerpt, titlepath, keywords = row
+                    if not wildcard and kind not in kinds:
+                        continue
+                    titlepath = json.loads(titlepath)
+                    d = min(trigram.substring_distance(pattern, s, distance)
+                            for s in [excerpt, *titlepath])
+                    if d > distance:
+                        continue
+                    results.append(((d, project, docname, pos), index_id,
+                                    (kind, excerpt, titlepath, json.loads(keywords))))
+
+        results.sort(key=lambda x: x[0])
+        return [(index_id, index) for _, index_id, index in results[:limit]]
+
+
+    def complete(self, prefix:str, projects:Optional[List[str]]=None,
+                 limit:int=10) -> List[str]:
+        """
+        Return keywords whose keys start with prefix, keywords of more
+        indexes come first. Pinyin initials of several Chinese keywords are
+        completed to the joined keywords.
+        """
+        prefix = prefix.lower()
+        keywords = Counter()
+        # Completions of pinyin initials of several Chinese keywords, such as
+        # "zwfc" or "zwf" (中文分词), come after keywords
+        phrases = Counter()
+        for project in projects or self.shards():
+            if not path.exists(self.dbfile(project)):
+                continue
+            for keyword, n in self.complete_key(project, prefix):
+                keywords[keyword] += n
+            # Leading keys are split by split_completion_keys(), the last key
+            # is completed as prefix
+            for i in range(len(prefix) - 1, 0, -1):
+                keys = self.split_completion_keys(project, prefix[:i])
+                if not keys or any(x[0].isascii() for x in keys):
+                    continue
+                head = ''.join(x[0] for x in keys)
+                for keyword, n in self.complete_key(project, prefix[i:]):
+                    if not keyword.isascii():
+                        phrases[head + keyword] += n
+                break
+        completions = [keyword for keyword, _ in keywords.most_common()]
+        completions += [phrase for phrase, _ in phrases.most_common() if phrase not in keywords]
+        return completions[:limit]
+
+
+    def complete_key(self, project:str, prefix:str) -> List[Tuple[str,int]]:
+        """
+        Return keywords of project whose keys start with prefix, with their
+        number of indexes.
+        """
+        return self.conn(project).execute(
+            'SELECT DISTINCT c.keyword, k.n FROM completions c JOIN keywords k USING (keyword) '
+            'WHERE c.key >= ? AND c.key < ?', (prefix, prefix + '\U0010ffff')).fetchall()
+
+
+    def match_code(self, phrases:List[str], projects:Optional[List[str]]=None,
+                   kinds:str='*', limit:int=10) -> List[Tuple[IndexID,Index]]:
+        """
+        Return indexes of given kinds whose code contains all given phrases,
+        ordered by their position in project. Code is indexed only if
+        :attr:`index_code` is true.
+        """
+        # Code of shell and other languages are tokenized differently (see
+        # :func:`codeindex.tokenize`), so each phrase is tokenized in both
+        # ways, a phrase matches if any of its forms matches
+        forms = []
+        for phrase in phrases:
+            alts = []
+            for language in ['console', None]:
+                tokens = [x[0] for x in codeindex.tokenize(phrase, language)]
+                if tokens and tokens not in alts:
+                    alts.append(tokens)
+            if alts:
+                forms.append(alts)
+        if not forms:
+            return []
+        wildcard = '*' in kinds
+
+        results = []
+        for project in projects or self.shards():
+            if not path.exists(self.dbfile(project)):
+                continue
+            conn = self.conn(project)
+            postings = {}
+            candidates = None
+            for alts in forms:
+                matched = set()
+                for tokens in alts:
+                    ids = candidates
+                    # Look up long token first, it is likely rare, so
+                    # candidates shrink quickly
+                    for token in sorted(set(tokens), key=len, reverse=True):
+                        if token not in postings:
+                            postings[token] = dict(conn.execute(
+                                'SELECT id, positions FROM code_postings WHERE token = ?', (token,)))
+                        ids = set(postings[token]) if ids is None else ids & postings[token].keys()
+                        if not ids:
+                            break
+                    matched |= ids
+                candidates = {index_id for index_id in matched
+                              if any(self._match_phrase(tokens, postings, index_id) for tokens in alts)}
+                if not candidates:
+                    break
+            matched = list(candidates)
+            for i in range(0, len(matched), 500):
+                chunk = matched[i:i+500]
+                for row in conn.execute('SELECT id, docname, pos, kind, excerpt, titlepath, keywords '
+                                        'FROM indexes WHERE id IN (%s)' % ','.join('?' * len(chunk)),
+                                        chunk):
+                    index_id, docname, pos, kind, excerpt, titlepath, keywords = row
+                    if not wildcard and kind not in kinds:
+                        continue
+                    results.append(((project, docname, pos), index_id,
+                                    (kind, excerpt, json.loads(titlepath), json.loads(keywords))))
+
+        results.sort(key=lambda x: x[0])
+        return [(index_id, index) for _, index_id, index in results[:limit]]
+
+
+    def _match_phrase(self, phrase:List[str], postings:Dict[str,Dict[IndexID,bytes]],
+                      index_id:IndexID) -> bool:
+        if any(index_id not in postings.get(token, {}) for token in phrase):
+            return False
+        positions = [set(codeindex.decode_positions(postings[token][index_id])) for token in phrase]
+        return any(all(start + i in positions[i] for i in range(1, len(phrase)))
+                   for start in positions[0])
+
+
+    def related(self, key:IndexID, projects:Optional[List[str]]=None,
+                limit:int=10) -> List[Tuple[IndexID,Index]]:
+        """
+        Return indexes related to given index, ordered by similarity. Only
+        indexes that share LSH buckets with it are compared, they are looked
+        up in shards of given projects (all projects by default).
+        """
+        sig = None
+        for project in self.shards():
+            if not path.exists(self.dbfile(project)):
+                continue
+            row = self.conn(project).execute('SELECT signature FROM signatures WHERE id = ?',
+                                             (key,)).fetchone()
+            if row:
+                sig = row[0]
+                break
+        if not sig:
+            return []
+        buckets = list(enumerate(minhash.buckets(sig)))
+
+        results = []
+        for project in projects or self.shards():
+            if not path.exists(self.dbfile(project)):
+                continue
+            conn = self.conn(project)
+            candidates = set()
+            for band, bucket in buckets:
+                candidates.update(row[0] for row in conn.execute(
+                    'SELECT id FROM bands WHERE band = ? AND bucket = ?', (band, bucket)))
+            candidates.discard(key)
+            for index_id in candidates:
+                row = conn.execute('SELECT s.signature, i.kind, i.excerpt, i.titlepath, i.keywords '
+                                   'FROM signatures s JOIN indexes i USING (id) WHERE id = ?',
+                                   (index_id,)).fetchone()
+                if not row:
+                    continue
+                results.append((minhash.similarity(sig, row[0]), index_id,
+                                (row[1], row[2], json.loads(row[3]), json.loads(row[4]))))
+
+        results.sort(key=lambda x: x[0], reverse=True)
+        return [(index_id, index) for _, index_id, index in results[:limit]]
+
+
+    def query_terms(self, query:str, projects:List[str]) -> List[str]:
+        """
+        Return terms of search query. Words are looked up as they are, and
+        are segmented like keywords only if they are never indexed.
+        Pinyin and pinyin initials (of one or more keywords) are replaced
+        with their keywords.
+        """
+        terms = []
+        for word in self.extractor.tokenize(self.extractor.normalize(query), segment=False):
+            for project in projects:
+                conn = self.conn(project)
+                if conn.execute('SELECT 1 FROM df WHERE term = ?', (word,)).fetchone():
+                    terms.append(word)
+                    break
+                keys = self.split_completion_keys(project, word)
+                if keys:
+                    terms += [keyword for keywords in keys for keyword in keywords]
+                    break
+            else:
+                terms += self.extractor.tokenize(word)
+        return terms
+
+
+    def split_completion_keys(self, project:str, word:str) -> List[List[str]]:
+        """
+        Split word into a sequence of completion keys, return keywords of
+        each key, keywords of more indexes come first. For example, "zwfc"
+        is split into "zw" ([中文]) and "fc" ([分词]).
+        """
+        conn = self.conn(project)
+        # Keywords of word[:i]
+        splits = {0: []}
+        for i in range(len(word)):
+            if i not in splits:
+                continue
+            for j in range(i + 1, len(word) + 1):
+                if j in splits:
+                    continue
+                keywords = [row[0] for row in conn.execute(
+                    'SELECT c.keyword FROM completions c JOIN keywords k USING (keyword) '
+                    'WHERE c.key = ? ORDER BY k.n DESC', (word[i:j],))]
+                if keywords:
+                    splits[j] = splits[i] + [keywords]
+        return splits.get(len(word), [])
+
+
+    def changes(self, projects:Optional[List[str]]=None) -> Dict[str,Dict[str,List[IndexID]]]:
+        """
+        Return changes of indexes since the last build of each project, in
+        project -> kind of change -> list of IndexID mapping.
+        """
+        changes = {}
+        for project in projects or self.shards():
+            if not path.exists(self.dbfile(project)):
+                continue
+            for index_id, change in self.conn(project).execute(
+                'SELECT id, change FROM changes ORDER BY docname'):
+                changes.setdefault(project, {}).setdefault(change, []).append(index_id)
+        return changes
+
+
+    def num_snippets_by_project(self, projects:Optional[List[str]]=None) -> Dict[str,int]:
+        """Return a project -> number of snippets mapping, read from manifest."""
+        rows = self.manifest().execute('SELECT project, num_snippets FROM shards '
+                                       'WHERE num_snippets > 0 ORDER BY project')
+        return {p: n for p, n in rows if not projects or p in projects}
+
+
+    def num_docs(self, projects:Optional[List[str]]=None) -> int:
+        """Return number of documents that have at least one snippet, read from manifest."""
+        rows = self.manifest().execute('SELECT project, num_docs FROM shards')
+        return sum(n for p, n in rows if not projects or p in projects)
+
+
+    def gen_index_ids(self, key:DocID, items:List[Item]) -> List[IndexID]:
+        """
+        Generate IDs for indexes of document.
+
+        ID is derived from project, docname and snippet identity, so an
+        unchanged snippet keeps its ID across builds. Snippets with same
+        identity are distinguished by their occurrence in document.
+        """
+        index_ids = []
+        occurrences = {}
+        for item in items:
+            identity = (item.snippet.kind(), item.snippet.refid(), item.snippet.excerpt())
+            n = occurrences[identity] = occurrences.get(identity, -1) + 1
+            hasher = sha1()
+            hasher.update(json.dumps([*key, *identity, n]).encode())
+            index_ids.append(hasher.hexdigest()[:10])
+        return index_ids
 
 
     def stringify(self, key:DocID, items:List[Item]) -> str:
@@ -9,18 +9,24 @@
 from __future__ import annotations
 import sys
 import argparse
-from typing import List
+import json
+from typing import List, TYPE_CHECKING
 from os import path
 from textwrap import dedent
 from shutil import get_terminal_size
 import posixpath
+import itertools
+import shlex
 
 from xdg.BaseDirectory import xdg_config_home
 
 from . import __title__, __version__, __description__
 from .config import Config
-from .cache import Cache
 from .table import tablify, COLUMNS
+from .utils import indexfile
+
+if TYPE_CHECKING:
+    from .cache import Cache
 
 DEFAULT_CONFIG_FILE = path.join(xdg_config_home, *__title__.split('-'), 'conf.py')
 
@@ -58,6 +64,8 @@ def main(argv:List[str]=sys.argv[1:]) -> int:
     statparser = subparsers.add_parser('stat', aliases=['s'],
                                        formatter_class=HelpFormatter,
                                        help='show snippets statistic information')
+    statparser.add_argument('--project', '-p', action='append',
+                            help='show specified project only, can be specified multiple times')
     statparser.set_defaults(func=_on_command_stat)
 
     listparser = subparsers.add_parser('list', aliases=['l'],
@@ -65,14 +73,70 @@ def main(argv:List[str]=sys.argv[1:]) -> int:
                                        help='list snippet indexes, columns of indexes: %s' % COLUMNS)
     listparser.add_argument('--kinds', '-k', type=str, default='*',
                             help='list specified kinds only')
+    listparser.add_argument('--project', '-p', action='append',
+                            help='list specified project only, can be specified multiple times')
     listparser.add_argument('--width', '-w', type=int,
                             default=get_terminal_size((120, 0)).columns,
                             help='width in characters of output')
     listparser.set_defaults(func=_on_command_list)
 
+    searchparser = subparsers.add_parser('search', aliases=['q'],
+                                         formatter_class=HelpFormatter,
+                                         help='search snippet indexes by keywords, excerpt and title path, '
+                                         'columns of indexes: %s' % COLUMNS)
+    searchparser.add_argument('--kinds', '-k', type=str, default='*',
+                              help='search specified kinds only')
+    searchparser.add_argument('--project', '-p', action='append',
+                              help='search specified project only, can be specified multiple times')
+    searchparser.add_argument('--limit', '-n', type=int, default=10,
+                              help='maximum number of results')
+    searchparser.add_argument('--substring', '-s', action='store_true',
+                              help='match query as a substring of excerpts and titles, '
+                              'rather than keywords')
+    searchparser.add_argument('--distance', '-d', type=int, default=0,
+                              help='maximum edit distance of substring matching, implies --substring')
+    searchparser.add_argument('--code', '-C', action='store_true',
+                              help='match query against code, quoted words are matched as a phrase '
+                              '(requires "index_code" configuration)')
+    searchparser.add_argument('--width', '-w', type=int,
+                              default=get_terminal_size((120, 0)).columns,
+                              help='width in characters of output')
+    searchparser.add_argument('query', type=str, nargs='+', help='search query')
+    searchparser.set_defaults(func=_on_command_search)
+
+    completeparser = subparsers.add_parser('complete', aliases=['c'],
+                                           formatter_class=HelpFormatter,
+                                           help='complete keyword by prefix of itself, its pinyin or pinyin initials '
+                                                '(of one or more keywords)')
+    completeparser.add_argument('--project', '-p', action='append',
+                                help='complete keywords of specified project only, can be specified multiple times')
+    completeparser.add_argument('--limit', '-n', type=int, default=10,
+                                help='maximum number of keywords')
+    completeparser.add_argument('prefix', type=str, help='prefix of keyword')
+    completeparser.set_defaults(func=_on_command_complete)
+
+    relatedparser = subparsers.add_parser('related', aliases=['r'],
+                                          formatter_class=HelpFormatter,
+                                          help='list snippet indexes related to given index ID, '
+                                          'columns of indexes: %s' % COLUMNS)
+    relatedparser.add_argument('--project', '-p', action='append',
+                               help='list indexes of specified project only, can be specified multiple times')
+    relatedparser.add_argument('--limit', '-n', type=int, default=10,
+                               help='maximum number of indexes')
+    relatedparser.add_argument('--width', '-w', type=int,
+                               default=get_terminal_size((120, 0)).columns,
+                               help='width in characters of output')
+    relatedparser.add_argument('index_id', type=str, help='index ID')
+    relatedparser.set_defaults(func=_on_command_related)
+
     getparser = subparsers.add_parser('get', aliases=['g'],
                                       formatter_class=HelpFormatter,
-                                      help='get information of snippet by index ID')
+                                      help='get information of snippets by index IDs',
+                                      description=dedent("""
+                                      Requested information of each snippet is printed
+                                      in order of --text, --file, --url, --line-start
+                                      and --line-end.
+                                      """))
     getparser.add_argument('--file', '-f', action='store_true',
                            help='get source file path of snippet')
     getparser.add_argument('--line-start', action='store_true',
@@ -80,10 +144,19 @@ def main(argv:List[str]=sys.argv[1:]) -> int:
     getparser.add_argument('--line-end', action='store_true',
                            help='get line number where snippet ends in source file')
     getparser.add_argument('--text', '-t', action='store_true',
-                           help='get source reStructuredText of snippet')
+                           help='get source reStructuredText of snippet (when it was built), '
+                           'warn if the source has changed since then')
     getparser.add_argument('--url', '-u', action='store_true',
                            help='get URL of HTML documentation of snippet')
-    getparser.add_argument('index_id', type=str, nargs='+', help='index ID')
+    getparser.add_argument('--project', '-p', action='append',
+                           help='look up index ID in specified project only, can be specified multiple times')
+    getformat = getparser.add_mutually_exclusive_group()
+    getformat.add_argument('--null', '-z', action='store_true',
+                           help='terminate each piece of information by NUL instead of newline')
+    getformat.add_argument('--json', '-j', action='store_true',
+                           help='print information of each snippet as a line of JSON object')
+    getparser.add_argument('index_id', type=str, nargs='+',
+                           help='index ID, "-" means reading whitespace separated index IDs from stdin')
     getparser.set_defaults(func=_on_command_get)
 
     igparser = subparsers.add_parser('integration', aliases=['i'],
@@ -108,11 +181,6 @@ def main(argv:List[str]=sys.argv[1:]) -> int:
         cfg = Config.load(args.config)
     setattr(args, 'cfg', cfg)
 
-    # Load snippet cache
-    cache = Cache(cfg.cache_dir)
-    cache.load()
-    setattr(args, 'cache', cache)
-
     # Call subcommand
     if hasattr(args, 'func'):
         args.func(args)
@@ -120,41 +188,125 @@ def main(argv:List[str]=sys.argv[1:]) -> int:
         parser.print_help()
 
 
+def _open_cache(args:argparse.Namespace) -> Cache:
+    """
+    Open snippet cache, import it lazily as not all subcommands need it.
+    Shards of cache are loaded on demand.
+    """
+    from .cache import Cache
+
+    if not path.isdir(args.cfg.cache_dir):
+        raise FileNotFoundError('no such directory: %s' % args.cfg.cache_dir)
+    return Cache(args.cfg.cache_dir)
+
+
 def _on_command_stat(args:argparse.Namespace):
-    cache = args.cache
+    cache = _open_cache(args)
 
-    num_projects = len(cache.num_snippets_by_project)
-    num_docs = len(cache.num_snippets_by_docid)
-    num_snippets = sum(cache.num_snippets_by_project.values())
+    num_snippets_by_project = cache.num_snippets_by_project(args.project)
+    num_projects = len(num_snippets_by_project)
+    num_docs = cache.num_docs(args.project)
+    num_snippets = sum(num_snippets_by_project.values())
     print(f'snippets are loaded from {cache.dirname}')
     print(f'configuration are loaded from {args.config}')
     print(f'integration files are located at {get_integration_file("")}')
     print('')
     print(f'I have {num_projects} project(s), {num_docs} documentation(s) and {num_snippets} snippet(s)')
-    for i, v in cache.num_snippets_by_project.items():
+    changes = cache.changes(args.project)
+    for i, v in num_snippets_by_project.items():
         print(f'project {i}:')
         print(f"\t {v} snippets(s)")
+        if i in changes:
+            print('\t ' + ', '.join(f'{len(ids)} {change}' for change, ids in changes[i].items()) +
+                  ' since last build')
 
 
 def _on_command_list(args:argparse.Namespace):
-    rows = tablify(args.cache.indexes, args.kinds, args.width)
+    filenames = indexfile.filenames(args.cfg.cache_dir, args.project)
+    indexes = itertools.chain.from_iterable(indexfile.load(f, args.kinds) for f in filenames)
+    rows = tablify(indexes, args.kinds, args.width)
+    for row in rows:
+        print(row)
+
+
+def _on_command_search(args:argparse.Namespace):
+    cache = _open_cache(args)
+    query = ' '.join(args.query)
+    if args.code:
+        try:
+            phrases = shlex.split(query)
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            sys.exit(1)
+        indexes = cache.match_code(phrases, args.project, args.kinds, args.limit)
+    elif args.substring or args.distance:
+        indexes = cache.match(query, args.project, args.kinds, args.limit, args.distance)
+    else:
+        indexes = cache.search(query, args.project, args.kinds, args.limit)
+    rows = tablify(indexes, args.kinds, args.width)
+    for row in rows:
+        print(row)
+
+
+def _on_command_complete(args:argparse.Namespace):
+    cache = _open_cache(args)
+    for keyword in cache.complete(args.prefix, args.project, args.limit):
+        print(keyword)
+
+
+def _on_command_related(args:argparse.Namespace):
+    cache = _open_cache(args)
+    indexes = cache.related(args.index_id, args.project, args.limit)
+    rows = tablify(indexes, '*', args.width)
     for row in rows:
         print(row)
 
 
 def _on_command_get(args:argparse.Namespace):
+    cache = _open_cache(args)
+    index_ids = []
     for index_id in args.index_id:
-        item = args.cache.get_by_index_id(index_id)
-        if not item:
-            print('no such index ID', file=sys.stderr)
-            sys.exit(1)
+        if index_id == '-':
+            index_ids += sys.stdin.read().split()
+        else:
+            index_ids.append(index_id)
+    # Documents and source files are read once for all index IDs
+    items = cache.get_many(index_ids, args.project)
+    texts, drifted = {}, set()
+    if args.text:
+        # Texts are served from snapshots taken at build time, snippets
+        # without snapshot are read from source
+        snapshots = cache.snapshots(items)
+        drifted = cache.drifted(items, snapshots)
+        texts = cache.texts({k: v for k, v in items.items() if k not in snapshots})
+        texts.update({k: lines for k, (_, lines) in snapshots.items()})
+
+    failed = False
+    for index_id in index_ids:
+        if index_id not in items:
+            if not args.null and not args.json:
+                print('no such index ID', file=sys.stderr)
+                sys.exit(1)
+            print('no such index ID: %s' % index_id, file=sys.stderr)
+            failed = True
+            continue
+        if args.text and index_id not in texts:
+            print('source of %s is not available' % index_id, file=sys.stderr)
+            if not args.null and not args.json:
+                sys.exit(1)
+            failed = True
+            continue
+        doc_id, item = items[index_id]
+        info = {}
         if args.text:
-            print('\n'.join(item.snippet.text()))
+            info['text'] = '\n'.join(texts[index_id])
+            if args.json:
+                info['drifted'] = index_id in drifted
+            elif index_id in drifted:
+                print('source of %s has changed since last build' % index_id, file=sys.stderr)
         if args.file:
-            print(item.snippet.file())
+            info['file'] = item.snippet.file()
         if args.url:
-            # HACK: get doc id in better way
-            doc_id, _ = args.cache.index_id_to_doc_id.get(index_id)
             base_url = args.cfg.base_urls.get(doc_id[0])
             if not base_url:
                 print(f'base URL for project {doc_id[0]} not configurated', file=sys.stderr)
@@ -162,11 +314,19 @@ def _on_command_get(args:argparse.Namespace):
             url = posixpath.join(base_url, doc_id[1] + '.html')
             if item.snippet.refid():
                 url +=  '#' + item.snippet.refid()
-            print(url)
+            info['url'] = url
         if args.line_start:
-            print(item.snippet.scope()[0])
+            info['line_start'] = item.snippet.scope()[0]
         if args.line_end:
-            print(item.snippet.scope()[1])
+            info['line_end'] = item.snippet.scope()[1]
+
+        if args.json:
+            print(json.dumps({'id': index_id, **info}, ensure_ascii=False))
+        else:
+            for value in info.values():
+                print(value, end='\0' if args.null else '\n')
+    if failed:
+        sys.exit(1)
 
 
 def _on_command_integration(args:argparse.Namespace):
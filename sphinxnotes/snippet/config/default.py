@@ -30,3 +30,33 @@ cache_dir = __path.join(__xdg_cache_home, *__title__.split('-'))
     Base URL is used to generate snippet URL.
 """
 base_urls = {}
+
+"""
+``keyword_memo_size``
+    (Type: ``int``)
+    (Default: ``65536``)
+    Maximum number of entries of the persistent keyword memo, which is
+    stored in cache directory and shared by all projects.
+    Set to ``0`` to disable the memo.
+"""
+keyword_memo_size = 65536
+
+"""
+``keyword_jobs``
+    (Type: ``int``)
+    (Default: ``1``)
+    Number of worker processes for keywords extraction.
+    When it is greater than ``1``, keywords are no longer extracted when
+    document is read, but extracted in batch by a process pool after all
+    documents are read.
+"""
+keyword_jobs = 1
+
+"""
+``index_code``
+    (Type: ``bool``)
+    (Default: ``False``)
+    Whether to build a full-text index of code block contents, which allows
+    searching code by phrases (``snippet search --code``).
+"""
+index_code = False
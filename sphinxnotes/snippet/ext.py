@@ -9,8 +9,11 @@
 """
 
 from __future__ import annotations
-from typing import List, Set, TYPE_CHECKING, Type, Dict
+from typing import List, Set, TYPE_CHECKING, Type, Dict, Optional, Tuple
 import re
+import json
+from os import path
+from hashlib import sha1
 
 from docutils import nodes
 
@@ -21,29 +24,62 @@ if TYPE_CHECKING:
 from sphinx.util import logging
 
 from .config import Config
-from . import Snippet, Headline, Code
-from .picker import pick_doctitle, pick_codes
-from .cache import Cache, Item
-from .keyword import Extractor
-from .utils.titlepath import resolve_fullpath, resolve_docpath
+from . import Snippet, Record, Headline, Code, __version__, clear_line_counts
+from . import picker, keyword
+from .picker import pick
+from .cache import Cache, Item, DocInfo, ADDED, MODIFIED, REMOVED
+from .keyword import Extractor, Memo, Job
+from .utils.titlepath import TitlePathTree, rebase
 from .builder import Builder
 
 
 logger = logging.getLogger(__name__)
 
 cache:Cache = None
+# Information of documents in cache, see :meth:`Cache.doc_infos`
+doc_infos:Dict[str,DocInfo] = {}
 extractor:Extractor = Extractor()
+# Number of worker processes for keywords extraction
+keyword_jobs:int = 1
 
-def extract_keywords(s:Snippet) -> List[str]:
+# Sphinx configurations that change doctree and thus picked snippets, for
+# example, language of literal block comes from ``highlight_language``
+FINGERPRINT_CONFIGS = ['highlight_language', 'rst_prolog', 'rst_epilog']
+
+def keyword_job(s:Record) -> Optional[Job]:
+    """Return arguments of keywords extraction of snippet."""
     # TODO: Deal with more snippet
-    if isinstance(s, Code):
-        return extractor.extract('\n'.join(map(lambda x:x.astext(), s.description)),
-                                 top_n=10)
-    elif isinstance(s, Headline):
-        return extractor.extract('\n'.join(map(lambda x:x.astext(), s.nodes())),
-                                 strip_stopwords=False)
+    # Keywords are ranked when they are indexed, see :meth:`Cache.rank_keywords`
+    if s.kind() == Code.kind():
+        return (s.astext(), None, True)
+    elif s.kind() == Headline.kind():
+        return (s.astext(), None, False)
     else:
-        logger.warning('unknown snippet instance %s', s)
+        logger.warning('unknown snippet kind %s', s.kind())
+        return None
+
+
+def extract_keywords(s:Record) -> List[str]:
+    if keyword_jobs > 1:
+        # Extracted in batch later, see :func:`extract_picked_keywords`
+        return []
+    job = keyword_job(s)
+    return extractor.extract(*job) if job else []
+
+
+def extract_picked_keywords(items:Dict[str,Tuple[str,Optional[List[Item]]]]) -> None:
+    """Extract keywords of picked items in batch by a process pool."""
+    jobs = []
+    for _, doc in items.values():
+        for item in doc or []:
+            jobs.append(keyword_job(item.snippet) or ('', None, False))
+    keywords = iter(extractor.extract_many(jobs, keyword_jobs))
+    for docname, (fp, doc) in items.items():
+        if doc is None:
+            continue
+        items[docname] = (fp, [Item(titlepath=item.titlepath,
+                                    snippet=item.snippet,
+                                    keywords=item.keywords + next(keywords)) for item in doc])
 
 
 def is_matched(pats:Dict[str,List[str]], cls:Type[Snippet], docname:str) -> bool:
@@ -59,73 +95,241 @@ def is_matched(pats:Dict[str,List[str]], cls:Type[Snippet], docname:str) -> bool
     return False
 
 
+def pick_items(app:Sphinx, doctree:nodes.document, docname:str) -> Optional[List[Item]]:
+    """
+    Pick snippets from doctree and extract their keywords.
+
+    Title paths of returned items only contain section titles, because
+    document titles are not available until all documents are read.
+    None is returned if document doesn't match any snippet patterns.
+    """
+    pats = app.config.snippet_patterns
+    headline = is_matched(pats, Headline, docname)
+    code = is_matched(pats, Code, docname)
+    if not headline and not code:
+        return None
+
+    items = []
+    # Pick document title and code snippets in one traversal
+    for snippet, sectpath in pick(doctree, headline=headline, code=code,
+                                  language=app.config.highlight_language):
+        record = snippet.record()
+        keywords = extract_keywords(record)
+        if isinstance(snippet, Headline):
+            keywords = [docname] + keywords
+        items.append(Item(titlepath=sectpath,
+                          snippet=record,
+                          keywords=keywords))
+    return items
+
+
+def fingerprint(app:Sphinx, docname:str) -> str:
+    """
+    Return fingerprint of document, which changes when the source of
+    document (and its dependencies) or the way we pick and index snippets
+    changes.
+    """
+    hasher = sha1()
+    hasher.update(json.dumps([__version__, picker.VERSION, keyword.VERSION,
+                              app.config.snippet_patterns, cache.index_code,
+                              [app.config[x] for x in FINGERPRINT_CONFIGS]],
+                             sort_keys=True, default=str).encode())
+    deps = [app.env.doc2path(docname)]
+    deps += [path.join(app.srcdir, x) for x in sorted(app.env.dependencies.get(docname, []))]
+    for dep in deps:
+        try:
+            with open(dep, 'rb') as f:
+                hasher.update(f.read())
+        except OSError:
+            hasher.update(dep.encode())
+    return hasher.hexdigest()
+
+
+def picked_items(env:BuildEnvironment) -> Dict[str,Tuple[str,Optional[List[Item]]]]:
+    """
+    Return items (and fingerprints of their documents) picked in current
+    build, which are not merged into cache yet.
+    """
+    if not hasattr(env, 'snippet_picked_items'):
+        env.snippet_picked_items = {}
+    return env.snippet_picked_items
+
+
+def titlepath_tree(env:BuildEnvironment) -> TitlePathTree:
+    """
+    Return title path tree of project, it is pickled with environment and
+    updated incrementally when documents are purged.
+    """
+    tree = getattr(env, 'snippet_titlepath_tree', None)
+    if tree is None or (tree.project, tree.master_doc) != (env.config.project,
+                                                      env.config.master_doc):
+        tree = env.snippet_titlepath_tree = TitlePathTree(env.config.project,
+                                                          env.config.master_doc)
+    return tree
+
+
 def on_config_inited(app:Sphinx, appcfg:SphinxConfig) -> None:
-    global cache
+    global cache, keyword_jobs
     cfg = Config(appcfg.snippet_config)
     cache = Cache(cfg.cache_dir)
+    keyword_jobs = cfg.keyword_jobs
+    if cfg.keyword_memo_size > 0:
+        extractor.memo = Memo(path.join(cfg.cache_dir, 'keywords.db'),
+                              cfg.keyword_memo_size)
+    # Titles are tokenized by cache when dumping
+    cache.extractor = extractor
+    cache.index_code = cfg.index_code
 
     try:
-        cache.load()
+        # Only shard of current project is needed
+        cache.load([appcfg.project])
     except Exception as e:
         logger.warning("failed to laod cache: %s" % e)
 
+    # Loaded here because parallel workers can not share database connection
+    global doc_infos
+    doc_infos = cache.doc_infos(appcfg.project)
+
 
 def on_env_get_outdated(app:Sphinx, env:BuildEnvironment, added:Set[str],
                          changed:Set[str], removed:Set[str]) -> List[str]:
     # Remove purged indexes and snippetes from db
     for docname in removed:
-        del cache[(app.config.project, docname)]
+        cache.pop((app.config.project, docname), None)
     return []
 
 
-def on_doctree_resolved(app:Sphinx, doctree:nodes.document, docname:str) -> None:
+def on_env_before_read_docs(app:Sphinx, env:BuildEnvironment, docnames:List[str]) -> None:
+    # Source files may change between builds
+    clear_line_counts()
+
+
+def on_env_purge_doc(app:Sphinx, env:BuildEnvironment, docname:str) -> None:
+    picked_items(env).pop(docname, None)
+    # Title of document may change
+    titlepath_tree(env).invalidate(docname)
+
+
+def on_doctree_read(app:Sphinx, doctree:nodes.document) -> None:
+    """
+    Pick snippets when document is read. It may run in parallel worker
+    processes, the picked items are merged by :func:`on_env_merge_info`.
+    """
     if not isinstance(doctree, nodes.document):
         # XXX: It may caused by ablog
         logger.debug('node %s is not nodes.document', type(doctree), location=doctree)
         return
+    docname = app.env.docname
+    fp = fingerprint(app, docname)
+    if docname in doc_infos and doc_infos[docname][0] == fp:
+        # Document is unchanged, reuse items in cache
+        return
+    picked_items(app.env)[docname] = (fp, pick_items(app, doctree, docname))
+    if extractor.memo:
+        # Worker process exits without notification, write back memo of
+        # each document
+        extractor.memo.flush()
+
+
+def on_env_merge_info(app:Sphinx, env:BuildEnvironment, docnames:Set[str],
+                      other:BuildEnvironment) -> None:
+    """Merge items (and fingerprints) picked by parallel worker process."""
+    other_items = picked_items(other)
+    for docname in docnames:
+        if docname in other_items:
+            picked_items(env)[docname] = other_items[docname]
+
 
+def on_env_updated(app:Sphinx, env:BuildEnvironment) -> List[str]:
+    """Complete title paths of picked items and put them into cache."""
+    items = picked_items(env)
+
+    # Documents that have been read but their snippets are missing from
+    # cache (for example, the cache is removed), pick them from pickled
+    # doctrees
     pats = app.config.snippet_patterns
-    matched = False
-
-    doc = cache.setdefault((app.config.project, docname), [])
-    # Pick document title from doctree
-    if is_matched(pats, Headline, docname):
-        matched = True
-        doctitle = pick_doctitle(doctree)
-        if doctitle:
-            doc.append(Item(titlepath=resolve_docpath(app.env,
-                                                      docname,
-                                                      include_project=True),
-                            snippet=doctitle,
-                            keywords=[docname] + extract_keywords(doctitle)))
-
-    # Pick code snippet from doctree
-    if is_matched(pats, Code, docname):
-        matched = True
-        codes = pick_codes(doctree)
-        for code in codes:
-            doc.append(Item(titlepath=resolve_fullpath(app.env,
-                                                       docname,
-                                                       code.nodes()[0],
-                                                       include_project=True),
-                            snippet=code,
-                            keywords=extract_keywords(code)))
-
-    if not matched:
-        del cache[(app.config.project, docname)]
+    for docname in env.found_docs:
+        if docname in items or docname in doc_infos:
+            continue
+        if not is_matched(pats, Headline, docname) and not is_matched(pats, Code, docname):
+            continue
+        items[docname] = (fingerprint(app, docname),
+                          pick_items(app, env.get_doctree(docname), docname))
+    if keyword_jobs > 1:
+        extract_picked_keywords(items)
+    if extractor.memo:
+        extractor.memo.flush()
+
+    tree = titlepath_tree(env)
+    for docname, (fp, doc) in items.items():
+        key = (app.config.project, docname)
+        if doc is None:
+            cache.pop(key, None)
+            doc_infos.pop(docname, None)
+            continue
+        docpath = tree.docpath(env.titles, docname)
+        memo = {}
+        cache[key] = [Item(titlepath=rebase(item.titlepath, 0, docpath, memo),
+                           snippet=item.snippet,
+                           keywords=item.keywords) for item in doc]
+        doc_infos[docname] = (fp, list(docpath))
+        cache.set_doc_info(key, doc_infos[docname])
+
+    # Title of parent documents may change, update title paths of documents
+    # whose items are reused
+    for docname, (fp, old_docpath) in doc_infos.items():
+        if docname in items or docname not in env.found_docs:
+            continue
+        docpath = tree.docpath(env.titles, docname)
+        if list(docpath) == old_docpath:
+            continue
+        key = (app.config.project, docname)
+        memo = {}
+        cache[key] = [Item(titlepath=rebase(item.titlepath, len(old_docpath), docpath, memo),
+                           snippet=item.snippet,
+                           keywords=item.keywords) for item in cache[key]]
+        doc_infos[docname] = (fp, list(docpath))
+        cache.set_doc_info(key, doc_infos[docname])
+
+    # Items have been put into cache, no need to pickle them with environment
+    items.clear()
+    return []
 
 
 def on_builder_finished(app:Sphinx, exception) -> None:
+    if not cache.is_dirty():
+        # Changes are of the last build
+        cache.clear_changes(app.config.project)
+        logger.info('snippet indexes: up to date')
+        return
     cache.dump()
 
+    changes = cache.changes([app.config.project]).get(app.config.project, {})
+    logger.info('snippet indexes: %d added, %d modified, %d removed',
+                *[len(changes.get(x, [])) for x in [ADDED, MODIFIED, REMOVED]])
+
 
 def setup(app:Sphinx):
     app.add_builder(Builder)
 
+    # Changing patterns requires documents to be picked again, so rebuild
+    # environment
     app.add_config_value('snippet_config', {}, '')
-    app.add_config_value('snippet_patterns', {'*':'.*'}, '')
+    app.add_config_value('snippet_patterns', {'*':'.*'}, 'env')
 
     app.connect('config-inited', on_config_inited)
     app.connect('env-get-outdated', on_env_get_outdated)
-    app.connect('doctree-resolved', on_doctree_resolved)
+    app.connect('env-before-read-docs', on_env_before_read_docs)
+    app.connect('env-purge-doc', on_env_purge_doc)
+    app.connect('doctree-read', on_doctree_read)
+    app.connect('env-merge-info', on_env_merge_info)
+    app.connect('env-updated', on_env_updated)
     app.connect('build-finished', on_builder_finished)
+
+    return {
+        'version': __version__,
+        # Snippets are picked when reading and merged in main process,
+        # nothing happens when writing
+        'parallel_read_safe': True,
+        'parallel_write_safe': True,
+    }
@@ -9,9 +9,171 @@
 """
 
 from __future__ import annotations
-from typing import List, Optional
+from typing import List, Optional, Dict, Tuple, Any
+import os
+import re
 import string
+import json
+import time
+import sqlite3
+from hashlib import sha1
 from collections import Counter
+from itertools import groupby
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+
+# Version of keywords extraction algorithm, bump it when the result of
+# :meth:`Extractor.extract` changes, so that stale memo is not used
+VERSION = 3
+
+MEMO_SCHEMA = """
+CREATE TABLE IF NOT EXISTS memo (
+    key TEXT PRIMARY KEY,
+    keywords TEXT NOT NULL,
+    atime REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS memo_by_atime ON memo (atime);
+"""
+
+# Arguments of :meth:`Extractor.extract`: (text, top_n, strip_stopwords)
+Job = Tuple[str,Optional[int],bool]
+
+class Memo(object):
+    """
+    A persistent memo of extracted keywords, which is shared by builds and
+    projects. Number of entries is bounded by capacity, least recently used
+    entries are evicted.
+
+    Connection to database is opened lazily by each process (Sphinx may
+    fork parallel workers), new entries and access times are written back in
+    batch by :meth:`flush`.
+    """
+
+    filename:str
+    capacity:int
+    # Entries that need write back
+    _pending:Dict[str,List[str]]
+    # Keys that are accessed since last flush
+    _accessed:Dict[str,float]
+    _conn:Optional[sqlite3.Connection]
+    # PID of process that opened the connection
+    _pid:Optional[int]
+
+    def __init__(self, filename:str, capacity:int) -> None:
+        self.filename = filename
+        self.capacity = capacity
+        self._pending = {}
+        self._accessed = {}
+        self._conn = None
+        self._pid = None
+
+
+    def conn(self) -> sqlite3.Connection:
+        if self._conn and self._pid == os.getpid():
+            return self._conn
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        self._conn = sqlite3.connect(self.filename, isolation_level=None, timeout=300)
+        self._conn.execute('PRAGMA journal_mode = WAL')
+        self._conn.execute('PRAGMA synchronous = NORMAL')
+        self._conn.executescript(MEMO_SCHEMA)
+        self._pid = os.getpid()
+        return self._conn
+
+
+    def key(self, text:str, *params) -> str:
+        """Return key of memo entry."""
+        hasher = sha1()
+        hasher.update(json.dumps([VERSION, text, *params]).encode())
+        return hasher.hexdigest()
+
+
+    def get(self, key:str) -> Optional[List[str]]:
+        if key in self._pending:
+            return self._pending[key]
+        row = self.conn().execute('SELECT keywords FROM memo WHERE key = ?', (key,)).fetchone()
+        if not row:
+            return None
+        self._accessed[key] = time.time()
+        return json.loads(row[0])
+
+
+    def put(self, key:str, keywords:List[str]) -> None:
+        self._pending[key] = keywords
+
+
+    def flush(self) -> None:
+        """Write back new entries and access times, evict entries if necessary."""
+        if not self._pending and not self._accessed:
+            return
+        now = time.time()
+        conn = self.conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany('INSERT OR REPLACE INTO memo VALUES (?, ?, ?)',
+                             [(k, json.dumps(v), now) for k, v in self._pending.items()])
+            conn.executemany('UPDATE memo SET atime = ? WHERE key = ?',
+                             [(v, k) for k, v in self._accessed.items()])
+            n = conn.execute('SELECT COUNT(*) FROM memo').fetchone()[0]
+            if n > self.capacity:
+                conn.execute('DELETE FROM memo WHERE key IN '
+                             '(SELECT key FROM memo ORDER BY atime LIMIT ?)',
+                             (n - self.capacity,))
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        self._pending = {}
+        self._accessed = {}
+
+
+# Names of NLP backends
+BACKENDS = ['jieba', 'wordsegment', 'pypinyin', 'stopwordsiso']
+
+# Scripts of character runs, see :meth:`Extractor.tokenize`
+HAN = 'han'
+LATIN = 'latin'
+DIGITS = 'digits'
+OTHER = 'other'
+SPACE = 'space'
+
+_ASCII_RUNS = re.compile(r'[a-zA-Z]+|[0-9]+')
+
+def _load_backend(name:str) -> Any:
+    """Import NLP lib and return its function we need."""
+    # Import NLP libs here to prevent import overhead
+    if name == 'jieba':
+        import jieba
+        jieba.initialize()
+        return jieba.cut_for_search
+    elif name == 'wordsegment':
+        from wordsegment import load, segment
+        load()
+        # Same words are segmented again and again
+        return lru_cache(maxsize=65536)(segment)
+    elif name == 'pypinyin':
+        from pypinyin import lazy_pinyin
+        return lazy_pinyin
+    elif name == 'stopwordsiso':
+        from stopwordsiso import stopwords
+        return stopwords(['en', 'zh'])
+    raise ValueError('unknown NLP backend: %s' % name)
+
+
+def _is_han(c:str) -> bool:
+    """Return whether character is a CJK unified ideograph."""
+    return '\u4e00' <= c <= '\u9fff' or '\u3400' <= c <= '\u4dbf'
+
+
+def _script(c:str) -> str:
+    """Return script of character."""
+    if _is_han(c):
+        return HAN
+    elif c.isdigit():
+        return DIGITS
+    elif c.isalpha():
+        # Basic Latin, Latin-1 Supplement, Latin Extended-A and B
+        return LATIN if c < '\u0250' else OTHER
+    return SPACE
 
 
 class Extractor(object):
@@ -21,22 +183,40 @@ class Extractor(object):
     TODO: extract date, time
     """
 
+    # Persistent memo of extracted keywords, optional
+    memo:Optional[Memo] = None
+    # Loaded NLP backends, see :func:`_load_backend`
+    _backends:Dict[str,Any]
+
     def __init__(self):
-        # Import NLP libs here to prevent import overhead
-        from langid import rank
-        from jieba import cut_for_search
-        from pypinyin import lazy_pinyin
-        from stopwordsiso import stopwords
-        from wordsegment import load, segment
+        # NLP backends are loaded on first use, so creating extractor is cheap
+        self._backends = {}
+        self._punctuation = string.punctuation + "！？｡。＂＃＄％＆＇（）＊＋，－／：；＜＝＞＠［＼］＾＿｀｛｜｝～｟｠｢｣､、〃》「」『』【】〔〕〖〗〘〙〚〛〜〝〞〟〰〾〿–—‘’‛“”„‟…‧﹏.·"
 
-        load()
-        self._detect_langs = rank
-        self._tokenize_zh_cn = cut_for_search
-        self._tokenize_en = segment
-        self._pinyin = lazy_pinyin
-        self._stopwords = stopwords
+    def __getstate__(self) -> Dict[str,Any]:
+        # Backends and memo can not be pickled, they are loaded again
+        # by process that unpickles extractor
+        state = self.__dict__.copy()
+        state['_backends'] = {}
+        state.pop('memo', None)
+        return state
+
+
+    def backend(self, name:str) -> Any:
+        """Return NLP backend of given name, load it if necessary."""
+        if name not in self._backends:
+            self._backends[name] = _load_backend(name)
+        return self._backends[name]
+
+
+    def warmup(self) -> None:
+        """
+        Load all NLP backends in advance. Processes forked from here reuse
+        the loaded backends.
+        """
+        for name in BACKENDS:
+            self.backend(name)
 
-        self._punctuation = string.punctuation + "！？｡。＂＃＄％＆＇（）＊＋，－／：；＜＝＞＠［＼］＾＿｀｛｜｝～｟｠｢｣､、〃》「」『』【】〔〕〖〗〘〙〚〛〜〝〞〟〰〾〿–—‘’‛“”„‟…‧﹏.·"
 
     def extract(self, text:str,
                 top_n:Optional[int]=None,
@@ -45,6 +225,19 @@ class Extractor(object):
         # TODO: zh -> en
         # Normalize
         text = self.normalize(text)
+        if self.memo:
+            key = self.memo.key(text, top_n, strip_stopwords)
+            keywords = self.memo.get(key)
+            if keywords is not None:
+                return keywords
+        keywords = self._extract(text, top_n, strip_stopwords)
+        if self.memo:
+            self.memo.put(key, keywords)
+        return keywords
+
+
+    def _extract(self, text:str, top_n:Optional[int], strip_stopwords:bool) -> List[str]:
+        """Return keywords of given normalized text."""
         # Tokenize
         words = self.tokenize(text)
         # Invalid token removal
@@ -60,13 +253,42 @@ class Extractor(object):
         else:
             # Keep all keywords
             keywords = words
-        # Generate a pinyin version
-        keywords_pinyin = []
-        for word in keywords:
-            pinyin = self.trans_to_pinyin(word)
-            if pinyin:
-                keywords_pinyin.append(pinyin)
-        return keywords + keywords_pinyin
+        return keywords
+
+
+    def extract_many(self, jobs:List[Job], workers:int=1) -> List[List[str]]:
+        """
+        Like :meth:`extract`, but extract keywords of many texts at once.
+        Texts missing from memo are extracted in a pool of given number of
+        worker processes, each worker initializes its own extractor.
+        """
+        results = [None] * len(jobs)
+        misses = []
+        for i, (text, top_n, strip_stopwords) in enumerate(jobs):
+            text = self.normalize(text)
+            if self.memo:
+                key = self.memo.key(text, top_n, strip_stopwords)
+                results[i] = self.memo.get(key)
+            if results[i] is None:
+                misses.append((i, (text, top_n, strip_stopwords)))
+        if not misses:
+            return results
+
+        args = [x[1] for x in misses]
+        if workers > 1 and len(misses) > 1:
+            self.warmup()
+            with ProcessPoolExecutor(workers, initializer=_init_worker,
+                                     initargs=(self,)) as pool:
+                chunksize = max(1, len(args) // (workers * 4))
+                keywords = list(pool.map(_extract_in_worker, args, chunksize=chunksize))
+        else:
+            keywords = [self._extract(*x) for x in args]
+
+        for (i, (text, top_n, strip_stopwords)), kws in zip(misses, keywords):
+            results[i] = kws
+            if self.memo:
+                self.memo.put(self.memo.key(text, top_n, strip_stopwords), kws)
+        return results
 
 
     def normalize(self, text:str) -> str:
@@ -81,30 +303,43 @@ class Extractor(object):
         return text
 
 
-    def tokenize(self, text:str) -> List[str]:
-        # Get top most 5 langs
-        langs = self._detect_langs(text)[:5]
-        tokens = [text]
-        new_tokens = []
-        for lang in langs:
-            for token in tokens:
-                if lang[0] == 'zh':
-                    new_tokens += self._tokenize_zh_cn(token)
-                elif lang[0] == 'en':
-                    new_tokens += self._tokenize_en(token)
-                else:
-                    new_tokens += token.split(' ')
-            tokens = new_tokens
-            new_tokens = []
+    def tokenize(self, text:str, segment:bool=True) -> List[str]:
+        """
+        Split text into runs of script (Han, Latin, digits and others), each
+        run is tokenized exactly once by tokenizer of its script.
+
+        If segment is false, Latin runs are not segmented into words.
+        """
+        if text.isascii():
+            # Fast path: text is made of Latin and digits runs
+            runs = ((LATIN if r[0].isalpha() else DIGITS, r) for r in _ASCII_RUNS.findall(text))
+        else:
+            runs = ((script, ''.join(chars)) for script, chars in groupby(text, _script))
+        tokens = []
+        for script, run in runs:
+            if script == HAN:
+                tokens += self.backend('jieba')(run)
+            elif script == LATIN and run.isascii() and segment:
+                tokens += self.backend('wordsegment')(run)
+            elif script != SPACE:
+                # Words of other scripts are kept as they are
+                tokens.append(run)
         return tokens
 
 
-    def trans_to_pinyin(self, word:str) -> Optional[str]:
-        return ' '.join(self._pinyin(word, errors='ignore'))
+    def pinyin(self, word:str) -> List[str]:
+        """
+        Return pinyin syllables of Chinese word, non-Chinese characters are
+        kept as they are. Empty list is returned for non-Chinese word.
+        """
+        if not any(_is_han(c) for c in word):
+            # Avoid loading pypinyin for non-Chinese word
+            return []
+        return self.backend('pypinyin')(word)
 
 
     def strip_stopwords(self, words:List[str]) -> List[str]:
-        stw = self._stopwords(['en', 'zh'])
+        stw = self.backend('stopwordsiso')
         new_words = []
         for word in words:
             if not word in stw:
@@ -114,3 +349,15 @@ class Extractor(object):
 
     def strip_invalid_token(self, tokens:List[str]) -> List[str]:
         return [token for token in tokens if token  != '']
+
+
+# Extractor of worker process of :meth:`Extractor.extract_many`
+_worker_extractor:Optional[Extractor] = None
+
+def _init_worker(extractor:Extractor) -> None:
+    global _worker_extractor
+    _worker_extractor = extractor
+
+
+def _extract_in_worker(job:Job) -> List[str]:
+    return _worker_extractor._extract(*job)
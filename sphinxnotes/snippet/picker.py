@@ -9,82 +9,161 @@
 """
 
 from __future__ import annotations
-from typing import List, Optional, Dict
+from typing import List, Optional, Tuple
 
 from docutils import nodes
-
-from . import Headline, Code
-from .utils.titlepath import resolve_doctitle
-
-
-def pick_doctitle(doctree:nodes.document) -> Optional[Headline]:
-    """Pick document title and subtitle (if have) from document."""
-    title, subtitle = resolve_doctitle(doctree)
-    if not title:
-        return None
-    return Headline(title=title, subtitle=subtitle)
-
-
-def pick_codes(doctree:nodes.document) -> List[Code]:
-    """Pick code snippet from document."""
-    picker = CodePicker(doctree)
-    doctree.walkabout(picker)
-    return picker.codes
-
-
-class CodePicker(nodes.SparseNodeVisitor):
-    """Node visitor for picking code snippet from document."""
-    # Code snippets that picked from document
-    codes:List[Code]
-    # (container, pointer) that Recording the read pointer inside container
-    offset:Dict[nodes.Node,int]
+from sphinx import addnodes
+
+from . import Snippet, Headline, Code, LineTable
+from .utils.titlepath import TitlePath, ROOT
+
+# Version of picking algorithm, bump it when the picked snippets of a
+# document may change, so that documents are picked again
+VERSION = 4
+
+# Snippet and its section path (titles of sections that snippet belongs to,
+# from inner to outer)
+Picked = Tuple[Snippet,TitlePath]
+
+def pick(doctree:nodes.document, headline:bool=True, code:bool=True,
+         language:str='default') -> List[Picked]:
+    """
+    Pick snippets of given kinds from document in a single traversal,
+    language is the default language of literal blocks
+    (``highlight_language``).
+    """
+    picker = SnippetPicker(headline, code, language)
+    picker.walk(doctree)
+    if picker.picked:
+        # Line table holds every node of doctree, it is dropped once
+        # snippets are located
+        table = LineTable(doctree)
+        for snippet, _ in picker.picked:
+            snippet.locate(table)
+    return picker.picked
+
+
+class SnippetPicker(object):
+    """
+    Picker that picks snippets from document by walking doctree once.
+
+    Section path is tracked as the walk goes, snippets in the same section
+    share the same :class:`TitlePath` object. Code descriptions are
+    collected by position: each container has a read pointer, nodes before
+    the pointer have been used by previous code.
+    """
+    # Snippets that picked from document
+    picked:List[Picked]
+    # Path of section that current node belongs to
+    sectpath:TitlePath
+    # Subtitle of document, which is not a section title of snippets
+    subtitle:Optional[nodes.title]
+    # Whether the document title has been seen
+    seen_doctitle:bool
+    # Language and force flag of literal blocks without language, changed
+    # by :rst:dir:`highlight` directive
+    highlight:Tuple[str,bool]
     # List of unsupported languages (:class:`pygments.lexers.Lexer`)
     unsupported_languages:List[str] = ['default']
 
-
-    def __init__(self, document:nodes.document) -> None:
-        super().__init__(document)
-        self.codes = []
-        self.offset = {}
-
-
-    def visit_literal_block(self, node:nodes.literal_block) -> None:
-        if node['language'] in self.unsupported_languages:
-            raise nodes.SkipNode
-
-        desc = []
-        container = node.parent
-        # Get current offset or use first child of container (must exists)
-        start = self.offset.get(container) or 0
-        # Stop iteration before current literal_block
-        end = container.index(node)
-        # Collect description
-        for i in range(start, end):
-            if self.is_description(container[i]):
-                desc.append(container[i])
-        i += 1 # Skip literal_block
+    def __init__(self, headline:bool=True, code:bool=True, language:str='default') -> None:
+        self.headline = headline
+        self.code = code
+        self.picked = []
+        self.sectpath = ROOT
+        self.subtitle = None
+        self.seen_doctitle = False
+        self.highlight = (language, False)
+
+
+    def walk(self, node:nodes.Element) -> None:
+        if isinstance(node, nodes.section) and not self.seen_doctitle:
+            self.seen_doctitle = True
+            self.visit_doctitle(node)
+
+        titled = len(node.children) > 0 and isinstance(node[0], nodes.title) \
+                and node[0] is not self.subtitle
+        if titled:
+            self.sectpath = TitlePath(node[0].astext(), self.sectpath)
+
+        children = node.children
+        # Read pointer of children
+        start = 0
+        for i, child in enumerate(children):
+            if isinstance(child, addnodes.highlightlang):
+                self.highlight = (child['lang'], child['force'])
+            elif isinstance(child, nodes.literal_block):
+                if not self.code:
+                    continue
+                self.resolve_language(child)
+                if self.is_supported(child):
+                    start = self.visit_literal_block(child, children, start, i)
+                else:
+                    # Description of unsupported code is not for next code
+                    start = i + 1
+            elif isinstance(child, nodes.Element):
+                self.walk(child)
+
+        if titled:
+            self.sectpath = self.sectpath.parent
+
+
+    def visit_doctitle(self, node:nodes.section) -> None:
+        """Pick title and subtitle from the top level section of document."""
+        title = node[0] if len(node) and isinstance(node[0], nodes.title) else None
+        # NOTE: nodes.subtitle does not make senses beacuse Sphinx doesn't support
+        # subtitle:
+        #
+        # > Sphinx does not support a "subtitle".
+        # > Sphinx recognizes it as a mere second level section
+        #
+        # ref:
+        # - https://github.com/sphinx-doc/sphinx/issues/3574#issuecomment-288722585
+        # - https://github.com/sphinx-doc/sphinx/issues/3567#issuecomment-288093991
+        #
+        # HACK: For our convenience, we regard second level section title
+        # (under document) as subtitle::
+        # <section>
+        #   <title>
+        #   <section>
+        #       <(sub)title>
+        if len(node) == 2 and len(node[1]) and isinstance(node[1][0], nodes.title):
+            self.subtitle = node[1][0]
+        if self.headline and title:
+            self.picked.append((Headline(title=title, subtitle=self.subtitle), ROOT))
+
+
+    def visit_literal_block(self, node:nodes.literal_block, siblings:List[nodes.Node],
+                            start:int, end:int) -> int:
+        """
+        Pick code snippet of literal block, which is the end-th node of
+        siblings, return the new read pointer.
+        """
+        # Collect description after read pointer
+        desc = [x for x in siblings[start:end] if self.is_description(x)]
         # Collect continuously post_description
-        for i in range(i, len(container)):
-            if self.is_post_description(container[i]):
-                desc.append(container[i])
-            else:
-                i -= 1 # Currnet node is not post_description
-                break
-        i += 1 # Skip last post_description
-
-        self.offset[container] = i
+        i = end + 1
+        while i < len(siblings) and self.is_post_description(siblings[i]):
+            desc.append(siblings[i])
+            i += 1
         if desc:
             # Only add code with description
-            self.codes.append(Code(description=desc,
-                                   block=node))
+            self.picked.append((Code(description=desc, block=node), self.sectpath))
+        return i
 
 
-    def unknown_visit(self, node:nodes.Node) -> None:
-        pass # Ignore any unknown node
+    def resolve_language(self, node:nodes.literal_block) -> None:
+        """
+        Set language of literal block in the same way as Sphinx's
+        ``HighlightLanguageTransform``, which is a post-transform and runs
+        after snippets are picked.
+        """
+        if 'language' not in node:
+            node['language'], node['force'] = self.highlight
 
 
-    def unknown_departure(self, node:nodes.Node) -> None:
-        pass # Ignore any unknown node
+    def is_supported(self, node:nodes.literal_block) -> bool:
+        return node.get('language', 'default') not in self.unsupported_languages
 
 
     def is_description(self, node:nodes.Node) -> bool:
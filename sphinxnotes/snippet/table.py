@@ -7,16 +7,18 @@
 """
 
 from __future__ import annotations
-from typing import Iterator, Dict
+from typing import Iterator, Iterable, Tuple, TYPE_CHECKING
 
-from .cache import Index, IndexID
 from .utils import ellipsis
 
+if TYPE_CHECKING:
+    from .cache import Index, IndexID
+
 COLUMNS = ['id', 'kind', 'excerpt', 'path', 'keywords']
 VISIABLE_COLUMNS = COLUMNS[1:4]
 COLUMN_DELIMITER = '  '
 
-def tablify(indexes: Dict[IndexID,Index], kinds:str, width:int) -> Iterator[str]:
+def tablify(indexes: Iterable[Tuple[IndexID,Index]], kinds:str, width:int) -> Iterator[str]:
     """ Create a table from sequence of cache.Index. """
 
     # Calcuate width
@@ -37,7 +39,7 @@ def tablify(indexes: Dict[IndexID,Index], kinds:str, width:int) -> Iterator[str]
     yield header
 
     # Write rows
-    for index_id, index in indexes.items():
+    for index_id, index in indexes:
         # TODO: assert index?
         if index[0] not in kinds and '*' not in kinds:
             continue
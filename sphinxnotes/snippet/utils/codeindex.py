@@ -0,0 +1,84 @@
+"""
+    sphinxnotes.utils.codeindex
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Helper functions for positional full-text index of code, which supports
+    phrase queries.
+
+    Code is tokenized by its language: in shell sessions, flags (``--onto``)
+    and paths (``/usr/bin/env``) are kept as single tokens, components of a
+    path are also indexed at the same position; in other languages, code is
+    split into words. Tokens are case insensitive.
+
+    Positions of a token are stored as delta-encoded varints.
+
+    :copyright: Copyright 2021 Shengyu Zhang
+    :license: BSD, see LICENSE for details.
+"""
+
+from __future__ import annotations
+from typing import List, Dict, Optional
+import re
+
+# Languages of shell session and script
+SHELL_LANGUAGES = {'console', 'shell', 'sh', 'bash', 'zsh', 'fish', 'shell-session',
+                   'bat', 'batch', 'powershell', 'ps1', 'doscon', 'pwsh'}
+
+_SHELL_TOKEN = re.compile(r'--?\w[\w-]*|[\w.~-]*/[\w./~-]*|\w+')
+_WORD = re.compile(r'\w+')
+
+def tokenize(code:str, language:Optional[str]=None) -> List[List[str]]:
+    """
+    Return tokens of code, in form of a list of positions, each position
+    holds one or more tokens, the first one is the main token.
+    """
+    code = code.lower()
+    if language not in SHELL_LANGUAGES:
+        return [[word] for word in _WORD.findall(code)]
+    positions = []
+    for token in _SHELL_TOKEN.findall(code):
+        if '/' in token and not token.startswith('-'):
+            positions.append([token] + [x for x in _WORD.findall(token) if x != token])
+        else:
+            positions.append([token])
+    return positions
+
+
+def postings(code:str, language:Optional[str]=None) -> Dict[str,List[int]]:
+    """Return a token -> positions mapping of code."""
+    postings = {}
+    for i, tokens in enumerate(tokenize(code, language)):
+        for token in tokens:
+            positions = postings.setdefault(token, [])
+            if not positions or positions[-1] != i:
+                positions.append(i)
+    return postings
+
+
+def encode_positions(positions:List[int]) -> bytes:
+    """Encode ascending positions to bytes."""
+    buf = bytearray()
+    prev = 0
+    for pos in positions:
+        delta = pos - prev
+        prev = pos
+        while delta >= 0x80:
+            buf.append((delta & 0x7f) | 0x80)
+            delta >>= 7
+        buf.append(delta)
+    return bytes(buf)
+
+
+def decode_positions(data:bytes) -> List[int]:
+    """Decode bytes to positions, reverse of :func:`encode_positions`."""
+    positions = []
+    pos = delta = shift = 0
+    for b in data:
+        delta |= (b & 0x7f) << shift
+        if b & 0x80:
+            shift += 7
+            continue
+        pos += delta
+        positions.append(pos)
+        delta = shift = 0
+    return positions
@@ -0,0 +1,129 @@
+"""
+    sphinxnotes.utils.indexfile
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    A read-only, line oriented file of snippet indexes, which can be memory
+    mapped and streamed without loading the whole snippet cache.
+
+    Each line is a row of ``kind, id, excerpt, titlepath, keywords``, fields
+    are delimited by tab and list items are delimited by unit separator.
+    Kind is always the first byte of row, so rows can be filtered by kind
+    before decoding.
+
+    Rows are read and written in the same shape as
+    :py:meth:`sphinxnotes.snippet.cache.Cache.indexes`, there is one index
+    file per document, grouped by project, so a build only rewrites files
+    of the documents it changed.
+
+    :copyright: Copyright 2021 Shengyu Zhang
+    :license: BSD, see LICENSE for details.
+"""
+
+from __future__ import annotations
+from typing import Iterable, Iterator, List, Optional, Tuple
+import os
+import mmap
+import shutil
+import tempfile
+from urllib.parse import quote, unquote
+
+# Name of directory of index files under cache directory
+DIRNAME = 'index'
+FIELD_DELIMITER = '\t'
+LIST_DELIMITER = '\x1f'
+
+Row = Tuple[str,Tuple[str,str,List[str],List[str]]] # (id, (kind, excerpt, titlepath, keywords))
+
+def _escape(s:str) -> str:
+    return s.replace('\n', ' ') \
+            .replace(FIELD_DELIMITER, ' ') \
+            .replace(LIST_DELIMITER, ' ')
+
+
+def dirname(cache_dir:str, project:str) -> str:
+    """Return path to directory of index files of project."""
+    return os.path.join(cache_dir, DIRNAME, quote(project, safe=''))
+
+
+def filename(cache_dir:str, project:str, docname:str) -> str:
+    """Return path to index file of document."""
+    return os.path.join(dirname(cache_dir, project), quote(docname, safe=''))
+
+
+def filenames(cache_dir:str, projects:Optional[List[str]]=None) -> List[str]:
+    """
+    Return paths to index files of documents of given projects (all
+    projects by default), in order of project and docname.
+    """
+    if projects is None:
+        try:
+            projects = [unquote(x) for x in os.listdir(os.path.join(cache_dir, DIRNAME))]
+        except FileNotFoundError:
+            projects = []
+    files = []
+    for project in sorted(projects):
+        d = dirname(cache_dir, project)
+        if not os.path.isdir(d):
+            continue
+        files += [os.path.join(d, x)
+                  for x in sorted(os.listdir(d), key=unquote) if not x.startswith('.')]
+    return files
+
+
+def clear(directory:str) -> None:
+    """Remove directory of index files of project."""
+    if os.path.isdir(directory):
+        shutil.rmtree(directory)
+    elif os.path.exists(directory):
+        # Index file of old layout, which holds all indexes of project
+        os.remove(directory)
+
+
+def remove(filename:str) -> None:
+    """Remove index file of document if it exists."""
+    try:
+        os.remove(filename)
+    except FileNotFoundError:
+        pass
+
+
+def dump(filename:str, rows:Iterable[Row]) -> None:
+    """Write rows to file, the file is replaced atomically."""
+    directory = os.path.dirname(filename)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmpfile = tempfile.mkstemp(dir=directory, prefix='.index-')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8', newline='\n') as f:
+            for index_id, (kind, excerpt, titlepath, keywords) in rows:
+                f.write(FIELD_DELIMITER.join([
+                    _escape(kind),
+                    _escape(index_id),
+                    _escape(excerpt),
+                    LIST_DELIMITER.join(map(_escape, titlepath)),
+                    LIST_DELIMITER.join(map(_escape, keywords))]))
+                f.write('\n')
+        os.replace(tmpfile, filename)
+    except:
+        os.remove(tmpfile)
+        raise
+
+
+def load(filename:str, kinds:str='*') -> Iterator[Row]:
+    """Stream rows of given kinds from file."""
+    wildcard = '*' in kinds
+    kinds = kinds.encode()
+    with open(filename, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            start = 0
+            end = mm.find(b'\n', start)
+            while end != -1:
+                if wildcard or mm[start] in kinds:
+                    kind, index_id, excerpt, titlepath, keywords = \
+                        mm[start:end].decode('utf-8').split(FIELD_DELIMITER)
+                    yield index_id, (kind, excerpt,
+                                     titlepath.split(LIST_DELIMITER) if titlepath else [],
+                                     keywords.split(LIST_DELIMITER) if keywords else [])
+                start = end + 1
+                end = mm.find(b'\n', start)
@@ -0,0 +1,65 @@
+"""
+    sphinxnotes.utils.lineindex
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Helper functions for line-offset index of source file, which maps line
+    number to byte offset, so a range of lines can be read by seeking
+    rather than reading from the beginning of file.
+
+    An index is only valid for the file of the same mtime and size.
+
+    :copyright: Copyright 2021 Shengyu Zhang
+    :license: BSD, see LICENSE for details.
+"""
+
+from __future__ import annotations
+from typing import List, Optional, Tuple
+from array import array
+import io
+import os
+
+# (mtime, size, offsets)
+LineIndex = Tuple[float,int,bytes]
+
+def build(filename:str) -> LineIndex:
+    """
+    Return line-offset index of file, offsets are byte offsets of start of
+    each line and the end of file.
+    """
+    stat = os.stat(filename)
+    offsets = array('Q', [0])
+    with open(filename, 'rb') as f:
+        for line in f:
+            offsets.append(offsets[-1] + len(line))
+    return (stat.st_mtime, stat.st_size, offsets.tobytes())
+
+
+def read(filename:str, index:LineIndex,
+         scopes:List[Tuple[int,Optional[int]]]) -> Optional[List[List[str]]]:
+    """
+    Return lines of file in each scope (see :meth:`Snippet.scope`) by given
+    index, file is opened once. None is returned if the index is outdated.
+    """
+    mtime, size, data = index
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    if (stat.st_mtime, stat.st_size) != (mtime, size):
+        return None
+    offsets = array('Q')
+    offsets.frombytes(data)
+    nlines = len(offsets) - 1
+    texts = []
+    with open(filename, 'rb') as f:
+        for scope in scopes:
+            start = min(max(scope[0] - 1, 0), nlines)
+            stop = min(scope[1] - 1, nlines) if scope[1] else nlines
+            if stop <= start:
+                texts.append([])
+                continue
+            f.seek(offsets[start])
+            data = f.read(offsets[stop] - offsets[start])
+            # Decode in the same way as reading file in text mode
+            texts.append([line.strip('\n') for line in io.TextIOWrapper(io.BytesIO(data))])
+    return texts
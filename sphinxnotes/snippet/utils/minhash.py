@@ -0,0 +1,55 @@
+"""
+    sphinxnotes.utils.minhash
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Helper functions for MinHash signatures and locality-sensitive hashing
+    (LSH), for finding similar sets without comparing all pairs.
+
+    A signature consists of :data:`NUM_HASHES` minimal hash values, its
+    :data:`NUM_BANDS` bands are hashed to buckets, two sets whose signatures
+    share a bucket are likely similar.
+
+    :copyright: Copyright 2021 Shengyu Zhang
+    :license: BSD, see LICENSE for details.
+"""
+
+from __future__ import annotations
+from typing import Iterable, List, Optional
+from hashlib import blake2b
+from array import array
+
+NUM_HASHES = 64
+NUM_BANDS = 16
+ROWS_PER_BAND = NUM_HASHES // NUM_BANDS
+
+# Each digest provides 16 hash values, salt makes them independent
+_SALTS = [b'%d' % i for i in range(NUM_HASHES // 16)]
+
+def _hashes(shingle:str) -> array:
+    data = shingle.encode()
+    values = array('I')
+    for salt in _SALTS:
+        values.frombytes(blake2b(data, digest_size=64, salt=salt).digest())
+    return values
+
+
+def signature(shingles:Iterable[str]) -> Optional[bytes]:
+    """Return MinHash signature of set of shingles, None for empty set."""
+    hashes = [_hashes(x) for x in set(shingles)]
+    if not hashes:
+        return None
+    return array('I', map(min, zip(*hashes))).tobytes()
+
+
+def similarity(sig1:bytes, sig2:bytes) -> float:
+    """Return estimated Jaccard similarity of two signatures."""
+    a, b = array('I', sig1), array('I', sig2)
+    return sum(x == y for x, y in zip(a, b)) / NUM_HASHES
+
+
+def buckets(sig:bytes) -> List[int]:
+    """Return buckets of bands of signature, in order of band."""
+    size = ROWS_PER_BAND * 4
+    return [int.from_bytes(blake2b(sig[i*size:(i+1)*size], digest_size=8).digest(),
+                           'little', signed=True)
+            for i in range(NUM_BANDS)]
@@ -11,16 +11,65 @@
 from __future__ import annotations
 import os
 from os import path
-from typing import Dict, Optional, Iterable, TypeVar
+from typing import Dict, Optional, Iterable, TypeVar, List
 import pickle
+import sqlite3
 from collections.abc import MutableMapping
-from hashlib import sha1
 
 K = TypeVar('K')
 V = TypeVar('V')
 
+# Schema of the underlying SQLite database, ``items`` holds the pickled
+# values, one row per key
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (key BLOB PRIMARY KEY, value BLOB NOT NULL);
+"""
+
+# Name of the only shard when PDict is not sharded
+DEFAULT_SHARD = 'dict'
+
+def _version(conn:sqlite3.Connection) -> int:
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def clear_outdated(conn:sqlite3.Connection, version:int) -> None:
+    """Drop all tables of database if its schema is not of given version."""
+    if _version(conn) == version:
+        return
+    conn.execute('BEGIN IMMEDIATE')
+    # Check again, other writer may have cleared it
+    if _version(conn) != version:
+        # Store can always be rebuilt, simply drop tables of other version
+        for table, in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall():
+            conn.execute('DROP TABLE IF EXISTS "%s"' % table)
+        conn.execute('PRAGMA user_version = %d' % version)
+    conn.execute('COMMIT')
+
+
 class PDict(MutableMapping):
-    """A persistent dict with event handlers."""
+    """
+    A persistent dict with event handlers.
+
+    Keys are partitioned into shards by :meth:`shard`, values of a shard are
+    stored in a SQLite database, all dirty and orphan items of a shard are
+    written back in one transaction, so the on-disk store is never torn.
+
+    The database runs in write-ahead log mode: a dump only appends the pages
+    it touched to the journal, which is folded back into the database file
+    once it grows larger than :attr:`journal_size_limit`.
+
+    Multiple processes can share the same database: readers never block,
+    and writers take the write lock only while dumping, so a dump merges
+    its own dirty and orphan items into what others have committed.
+    """
+
+    # Size in bytes of journal that triggers a compaction
+    journal_size_limit:int = 4 * 1024 * 1024
+    # Seconds to wait for other writers before giving up
+    lock_timeout:float = 300
+    # Version of :meth:`schema`, bump it when schema changes, database of
+    # an other version is cleared when it is opened
+    schema_version:int = 1
 
     dirname:str
     # The real in memory store of values
@@ -29,6 +78,8 @@ class PDict(MutableMapping):
     _dirty_items:Dict[K,V]
     # Items that need purge from store
     _orphan_items:Dict[K,V]
+    # Connections to databases of shards, opened on demand
+    _conns:Dict[str,sqlite3.Connection]
 
 
     def __init__(self, dirname:str) -> None:
@@ -36,6 +87,7 @@ class PDict(MutableMapping):
         self._store = {}
         self._dirty_items = {}
         self._orphan_items = {}
+        self._conns = {}
 
 
     def __getitem__(self, key:K) -> Optional[V]:
@@ -45,10 +97,14 @@ class PDict(MutableMapping):
         if value is not None:
             return value
         # V haven't loaded yet, load it from disk
-        with open(self.itemfile(key), 'rb') as f:
-            value = pickle.load(f)
-            self._store[key] = value
-            return value
+        row = self.conn(self.shard(key)).execute(
+            'SELECT value FROM items WHERE key = ?',
+            (self._keytransform(key),)).fetchone()
+        if not row:
+            raise KeyError
+        value = pickle.loads(row[0])
+        self._store[key] = value
+        return value
 
 
     def __setitem__(self, key:K, value:V) -> None:
@@ -75,60 +131,129 @@ class PDict(MutableMapping):
         return len(self._store)
 
 
-    def _keytransform(self, key:K) -> K:
-        # No used
-        return key
+    def is_dirty(self) -> bool:
+        """Return whether there are items need to be written back to disk."""
+        return bool(self._dirty_items or self._orphan_items)
+
 
+    def _keytransform(self, key:K) -> bytes:
+        """Transform key to the primary key of database."""
+        return pickle.dumps(key, protocol=4)
 
-    def load(self) -> None:
-        with open(self.dictfile(), 'rb') as f:
-            obj = pickle.load(f)
-            self.__dict__.update(obj.__dict__)
+
+    def conn(self, shard:str=DEFAULT_SHARD) -> sqlite3.Connection:
+        """
+        Return connection to database of shard, create the database if
+        necessary.
+        """
+        if shard in self._conns:
+            return self._conns[shard]
+        dbfile = self.dbfile(shard)
+        # Makesure dir exists
+        os.makedirs(path.dirname(dbfile), exist_ok=True)
+        # Transactions are managed by ourself, see :meth:`dump`
+        conn = sqlite3.connect(dbfile, isolation_level=None,
+                               timeout=self.lock_timeout)
+        conn.execute('PRAGMA journal_mode = WAL')
+        # Journal is compacted by ourself, see :meth:`compact`
+        conn.execute('PRAGMA wal_autocheckpoint = 0')
+        clear_outdated(conn, self.schema_version)
+        conn.executescript(self.schema())
+        self._conns[shard] = conn
+        return conn
+
+
+    def schema(self) -> str:
+        """Return SQL script for creating tables, subclass can extend it."""
+        return SCHEMA
+
+
+    def load(self, shards:Optional[List[str]]=None) -> None:
+        """
+        Load keys of given shards (all shards by default) from disk,
+        values are loaded on demand.
+        """
+        if shards is None:
+            shards = self.shards()
+        for shard in shards:
+            if not path.exists(self.dbfile(shard)):
+                raise FileNotFoundError('no such file: %s' % self.dbfile(shard))
+            for key, in self.conn(shard).execute('SELECT key FROM items'):
+                self._store[pickle.loads(key)] = None
 
 
     def dump(self):
-        """Dump store to disk."""
+        """Dump store to disk, each shard is dumped in its own transaction."""
         from sphinx.util import status_iterator
 
-        # Makesure dir exists
-        if not path.exists(self.dirname):
-            os.makedirs(self.dirname)
-
-        # Purge orphan items
-        for key, value in status_iterator(self._orphan_items.items(),
-                                          'purging orphan document(s)... ',
-                                          'brown', len(self._orphan_items), 0,
-                                          stringify_func=lambda i: self.stringify(i[0], i[1])):
-            os.remove(self.itemfile(key))
-            self.post_purge(key, value)
-
-        # Dump dirty items
-        for key, value in status_iterator(self._dirty_items.items(),
-                                          'dumping dirty document(s)... ',
-                                          'brown', len(self._dirty_items), 0,
-                                          stringify_func=lambda i: self.stringify(i[0], i[1])):
-            with open(self.itemfile(key), 'wb') as f:
-                pickle.dump(value, f)
-            self.post_dump(key, value)
-
-        # Clear all in-memory items
-        self._orphan_items = {}
-        self._dirty_items = {}
-        self._store = {key: None for key in self._store}
+        shards = {}
+        for key in self._orphan_items:
+            shards.setdefault(self.shard(key), ([], []))[0].append(key)
+        for key in self._dirty_items:
+            shards.setdefault(self.shard(key), ([], []))[1].append(key)
+
+        for shard, (orphan_keys, dirty_keys) in shards.items():
+            conn = self.conn(shard)
+            # Acquire write lock at the beginning, so that we never read data
+            # that is going to be overwritten by other writers
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                self.pre_dump(shard, orphan_keys, dirty_keys)
+
+                # Purge orphan items
+                for key in status_iterator(orphan_keys,
+                                           'purging orphan document(s)... ',
+                                           'brown', len(orphan_keys), 0,
+                                           stringify_func=lambda k: self.stringify(k, self._orphan_items[k])):
+                    conn.execute('DELETE FROM items WHERE key = ?',
+                                 (self._keytransform(key),))
+                    self.post_purge(key, self._orphan_items[key])
+
+                # Dump dirty items
+                for key in status_iterator(dirty_keys,
+                                           'dumping dirty document(s)... ',
+                                           'brown', len(dirty_keys), 0,
+                                           stringify_func=lambda k: self.stringify(k, self._dirty_items[k])):
+                    value = self._dirty_items[key]
+                    conn.execute('INSERT OR REPLACE INTO items VALUES (?, ?)',
+                                 (self._keytransform(key), pickle.dumps(value)))
+                    self.post_dump(key, value)
+
+                self.pre_commit(shard)
+            except:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+
+            # Clear in-memory items of shard
+            for key in orphan_keys:
+                del self._orphan_items[key]
+            for key in dirty_keys:
+                del self._dirty_items[key]
+                self._store[key] = None
+
+            journal = self.dbfile(shard) + '-wal'
+            if path.exists(journal) and path.getsize(journal) > self.journal_size_limit:
+                self.compact(shard)
+
 
-        # Dump store itself
-        with open(self.dictfile(), 'wb') as f:
-            pickle.dump(self, f)
+    def compact(self, shard:str=DEFAULT_SHARD) -> None:
+        """Fold the journal of shard into database file and truncate it."""
+        self.conn(shard).execute('PRAGMA wal_checkpoint(TRUNCATE)')
 
 
-    def dictfile(self) -> str:
-        return path.join(self.dirname, 'dict.pickle')
+    def shard(self, key:K) -> str:
+        """Return name of shard that key belongs to."""
+        return DEFAULT_SHARD
 
 
-    def itemfile(self, key:K) -> str:
-        hasher = sha1()
-        hasher.update(pickle.dumps(key))
-        return path.join(self.dirname, hasher.hexdigest()[:7] + '.pickle')
+    def shards(self) -> List[str]:
+        """Return names of all shards on disk."""
+        return [DEFAULT_SHARD]
+
+
+    def dbfile(self, shard:str=DEFAULT_SHARD) -> str:
+        return path.join(self.dirname, shard + '.db')
 
 
     def post_dump(self, key:K, value:V) -> None:
@@ -139,5 +264,15 @@ class PDict(MutableMapping):
         pass
 
 
+    def pre_dump(self, shard:str, orphan_keys:List[K], dirty_keys:List[K]) -> None:
+        """Called at the beginning of dumping shard, while write lock is held."""
+        pass
+
+
+    def pre_commit(self, shard:str) -> None:
+        """Called at the end of dumping shard, while write lock is still held."""
+        pass
+
+
     def stringify(self, key:K, value:V) -> str:
         return key
@@ -2,109 +2,129 @@
     sphinxnotes.utils.titlepath
     ~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
-    Utils for ellipsis string.
+    Utils for title path of snippets.
+
+    A title path is a linked list of titles, from inner to outer. Title
+    paths of snippets in the same section or document share their outer
+    part, so they are stored once in memory and in a pickled document.
 
     :copyright: Copyright 2020 Shengyu Zhang
     :license: BSD, see LICENSE for details.
 """
 from __future__ import annotations
-from typing import List, Optional, Tuple, TYPE_CHECKING
-
-from docutils import nodes
+from typing import Dict, Iterator, Optional, TYPE_CHECKING
 
 if TYPE_CHECKING:
-    from sphinx.enviornment import BuilderEnviornment
+    from docutils import nodes
+
+
+class TitlePath(object):
+    """Immutable node of title path, :data:`ROOT` is the empty path."""
+    __slots__ = ('title', 'parent', 'depth')
+
+    title:Optional[str]
+    parent:Optional[TitlePath]
+    depth:int
+
+    def __init__(self, title:Optional[str]=None, parent:Optional[TitlePath]=None) -> None:
+        self.title = title
+        self.parent = parent
+        self.depth = parent.depth + 1 if parent is not None else 0
+
 
+    def __iter__(self) -> Iterator[str]:
+        node = self
+        while node.depth:
+            yield node.title
+            node = node.parent
 
-def _safe_descend(node:nodes.Node, *args: int) -> Optional[nodes.Node]:
-    """Get node descend in a safe way."""
-    try:
-        for index in args:
-            node = node[index]
-        return node
-    except:
-        return None
 
+    def __len__(self) -> int:
+        return self.depth
 
-def resolve_fullpath(env: BuilderEnviornment, docname:str, node:nodes.Node,
-                     include_project:bool=False) -> List[str]:
-    return [x.astext() for x in resolve_sectpath(node.document, node)] + \
-        resolve_docpath(env, docname, include_project=include_project)
 
+    def __repr__(self) -> str:
+        return 'TitlePath(%r)' % list(self)
 
-def resolve_sectpath(doctree:nodes.document, node:nodes.Node) -> List[nodes.title]:
-    # FIXME: doc is None
-    _, subtitlenode = resolve_doctitle(doctree)
-    titlenodes = []
-    while node:
-        secttitle = resolve_secttitle(node)
-        node = node.parent
-        if not secttitle or secttitle == subtitlenode:
-            continue
-        titlenodes.append(secttitle)
-    return titlenodes
 
+ROOT = TitlePath()
 
-def resolve_secttitle(node:nodes.Node) -> Optional[nodes.title]:
-    titlenode = _safe_descend(node.parent, 0)
-    if not isinstance(titlenode, nodes.title):
-        return None
-    return titlenode
 
+def rebase(path:TitlePath, n:int, root:TitlePath, memo:Dict[int,TitlePath]) -> TitlePath:
+    """
+    Return path whose outermost n titles are replaced by root.
 
-def resolve_docpath(env:BuilderEnviornment, docname:str, include_project:bool=False) -> List[str]:
-    titles = []
+    Results are memoized by identity of node, so paths sharing nodes still
+    share nodes after rebasing.
+    """
+    if len(path) <= n:
+        return root
+    if id(path) not in memo:
+        memo[id(path)] = TitlePath(path.title, rebase(path.parent, n, root, memo))
+    return memo[id(path)]
 
-    if include_project:
-        titles.append(env.config.project)
 
-    master_doc = env.config.master_doc
-    v = docname.split('/')
-    if v.pop() == master_doc:
-        if v:
+class TitlePathTree(object):
+    """
+    Title paths of documents of project, built from titles of master
+    documents (``env.titles``) on demand.
+
+    A docname prefix ``a/b`` is resolved to title of ``a/b/index`` (or
+    ``B`` if it is missing) whose parent is path of ``a``, the empty prefix
+    is resolved to project name.
+    """
+    project:str
+    master_doc:str
+    # Docname prefix -> resolved title path
+    _paths:Dict[str,TitlePath]
+
+    def __init__(self, project:str, master_doc:str) -> None:
+        self.project = project
+        self.master_doc = master_doc
+        self._paths = {}
+
+
+    def docpath(self, titles:Dict[str,nodes.title], docname:str) -> TitlePath:
+        """Return title path of document, root document has empty path."""
+        v = docname.split('/')
+        if v.pop() == self.master_doc:
+            if not v:
+                # docname is "index", no need to get docpath, it is root doc
+                return ROOT
             # If docname is "a/b/index", we need titles of "a"
             v.pop()
+        return self.resolve(titles, '/'.join(v))
+
+
+    def resolve(self, titles:Dict[str,nodes.title], prefix:str) -> TitlePath:
+        """Return title path of docname prefix."""
+        if prefix in self._paths:
+            return self._paths[prefix]
+        if not prefix:
+            path = TitlePath(self.project, ROOT)
         else:
-            # docname is "index", no need to get docpath, it is root doc
-            return []
-    while v:
-        master_docname = '/'.join(v + [master_doc])
-        if master_docname in env.titles:
-            title = env.titles[master_docname].astext()
-        else:
-            title = v[-1].title()
-        titles.append(title)
-        v.pop()
-
-    return titles[::-1]  # Reverse inplace
-
-
-def resolve_doctitle(doctree:nodes.document) -> Tuple[Optional[nodes.title],
-                                                      Optional[nodes.title]]:
-
-    toplevel_sectnode = doctree.next_node(nodes.section)
-    if not toplevel_sectnode:
-        return (None, None)
-
-    titlenode = _safe_descend(toplevel_sectnode, 0)
-    # NOTE: nodes.subtitle does not make senses beacuse Sphinx doesn't support
-    # subtitle:
-    #
-    # > Sphinx does not support a "subtitle".
-    # > Sphinx recognizes it as a mere second level section
-    #
-    # ref:
-    # - https://github.com/sphinx-doc/sphinx/issues/3574#issuecomment-288722585
-    # - https://github.com/sphinx-doc/sphinx/issues/3567#issuecomment-288093991
-    if len(toplevel_sectnode) != 2:
-        return (titlenode, None)
-    # HACK: For our convenience, we regard second level section title
-    # (under document) as subtitle::
-    # <section>
-    #   <title>
-    #   <section>
-    #       <(sub)title>
-    subtitlenode = toplevel_sectnode[1][0]
-    if not isinstance(subtitlenode, nodes.title):
-        return (titlenode, None)
-    return (titlenode, subtitlenode)
+            parent, _, name = prefix.rpartition('/')
+            master_docname = prefix + '/' + self.master_doc
+            if master_docname in titles:
+                title = titles[master_docname].astext()
+            else:
+                title = name.title()
+            path = TitlePath(title, self.resolve(titles, parent))
+        self._paths[prefix] = path
+        return path
+
+
+    def invalidate(self, docname:str) -> None:
+        """
+        Forget paths that depend on title of given document, it should be
+        called when the document is added, changed or removed.
+        """
+        if docname != self.master_doc and not docname.endswith('/' + self.master_doc):
+            return
+        prefix = docname[:-len(self.master_doc)-1]
+        if not prefix:
+            # Title of root document is not used
+            return
+        for k in list(self._paths):
+            if k == prefix or k.startswith(prefix + '/'):
+                del self._paths[k]
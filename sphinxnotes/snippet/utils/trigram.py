@@ -0,0 +1,78 @@
+"""
+    sphinxnotes.utils.trigram
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Helper functions for trigram index, which supports substring and
+    approximate (bounded edit distance) substring matching.
+
+    Strings are padded with two trailing :data:`PAD`, so that a pattern
+    shorter than 3 characters is always the prefix of some trigram.
+
+    :copyright: Copyright 2021 Shengyu Zhang
+    :license: BSD, see LICENSE for details.
+"""
+
+from __future__ import annotations
+from typing import Set, Iterable, Tuple
+
+PAD = '\x00'
+
+def normalize(s:str) -> str:
+    return s.lower()
+
+
+def trigrams(strings:Iterable[str]) -> Set[str]:
+    """Return trigrams of given strings, strings are padded."""
+    grams = set()
+    for s in strings:
+        s = normalize(s) + PAD * 2
+        for i in range(len(s) - 2):
+            grams.add(s[i:i+3])
+    return grams
+
+
+def pattern_grams(pattern:str, n:int=3) -> Set[str]:
+    """Return n-grams (n <= 3) of pattern, pattern is not padded."""
+    pattern = normalize(pattern)
+    return {pattern[i:i+n] for i in range(len(pattern) - n + 1)}
+
+
+def candidate_grams(pattern:str, distance:int) -> Tuple[Set[str],int]:
+    """
+    Return grams of pattern and minimal number of them that a string must
+    contain, if it contains a substring within given edit distance of
+    pattern. An edit destroys at most n n-grams.
+
+    The longest grams that give a positive bound are chosen, grams shorter
+    than trigram are looked up as prefixes of trigrams. ``(set(), 0)`` is
+    returned if no gram works, then every string is a candidate.
+    """
+    for n in range(min(3, len(pattern)), 0, -1):
+        grams = pattern_grams(pattern, n)
+        threshold = len(grams) - n * distance
+        if threshold > 0:
+            return grams, threshold
+    return set(), 0
+
+
+def substring_distance(pattern:str, text:str, bound:int) -> int:
+    """
+    Return minimal edit distance between pattern and substrings of text,
+    or ``bound + 1`` if the distance is greater than bound.
+    """
+    pattern, text = normalize(pattern), normalize(text)
+    if pattern in text:
+        return 0
+    if bound == 0:
+        return 1
+    # Matching may start at any position of text, so first row is all zero
+    prev = [0] * (len(text) + 1)
+    for i, p in enumerate(pattern, 1):
+        cur = [i] + [0] * len(text)
+        for j, t in enumerate(text, 1):
+            cur[j] = min(prev[j] + 1, cur[j-1] + 1, prev[j-1] + (p != t))
+        if min(cur) > bound:
+            # Distance never decreases in following rows
+            return bound + 1
+        prev = cur
+    return min(min(prev), bound + 1)
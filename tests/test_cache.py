@@ -0,0 +1,193 @@
+"""
+    tests.test_cache
+    ~~~~~~~~~~~~~~~~
+
+    Tests of :class:`sphinxnotes.snippet.cache.Cache`.
+
+    :copyright: Copyright 2021 Shengyu Zhang
+    :license: BSD, see LICENSE for details.
+"""
+
+import unittest
+import tempfile
+import shutil
+from os import path
+
+from sphinxnotes.snippet import Record
+from sphinxnotes.snippet.cache import Cache, Item
+from sphinxnotes.snippet.utils.titlepath import ROOT
+
+
+class CacheTestCase(unittest.TestCase):
+    """Test case of cache in temporary directory."""
+    project = 'test'
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = Cache(path.join(self.tmpdir, 'cache'))
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+
+    def item(self, name, description, keywords, code=None):
+        """Return item of code snippet, description is the source text."""
+        filename = path.join(self.tmpdir, name + '.rst')
+        with open(filename, 'w') as f:
+            f.write(description + '\n')
+        record = Record(kind='c', file=filename, scope=(1, 2), refid=None,
+                        language='console', excerpt='/console/ ' + description,
+                        description=description, code=code)
+        return Item(snippet=record, titlepath=ROOT, keywords=keywords)
+
+
+    def dump(self, docs):
+        """Set (or remove, if value is None) items of documents and dump."""
+        for docname, items in docs.items():
+            key = (self.project, docname)
+            if items is None:
+                del self.cache[key]
+            else:
+                self.cache[key] = items
+        self.cache.dump()
+
+
+    def ids(self, docname):
+        """Return IDs of indexes of document, in order of position."""
+        return [index_id for index_id, _ in self.cache.indexes(self.project, docname)]
+
+
+    def df(self):
+        conn = self.cache.conn(self.project)
+        return dict(conn.execute('SELECT term, n FROM df'))
+
+
+    def stats(self):
+        conn = self.cache.conn(self.project)
+        stats = conn.execute('SELECT num_docs, num_snippets, num_terms FROM stats').fetchone()
+        manifest = self.cache.manifest().execute(
+            'SELECT num_docs, num_snippets, num_terms FROM shards WHERE project = ?',
+            (self.project,)).fetchone()
+        self.assertEqual(stats, manifest)
+        return stats
+
+
+    def assertConsistent(self):
+        """Assert that statistics agree with postings and indexes."""
+        conn = self.cache.conn(self.project)
+        self.assertEqual(self.df(), dict(conn.execute(
+            'SELECT term, COUNT(*) FROM postings GROUP BY term')))
+        num_docs, num_snippets, num_terms = conn.execute(
+            'SELECT COUNT(DISTINCT docname), COUNT(*), TOTAL(length) FROM indexes').fetchone()
+        self.assertEqual(self.stats(), (num_docs, num_snippets, int(num_terms)))
+
+
+class TestTerms(CacheTestCase):
+    def test_dump_edit_purge(self):
+        self.dump({'git': [self.item('rebase', 'Rebase onto branch', ['git', 'rebase', 'git']),
+                           self.item('status', 'Show status', ['git', 'status'])],
+                   'pip': [self.item('pip', 'Install package', ['pip', 'install'])]})
+        self.assertEqual(self.df(), {'git': 2, 'rebase': 1, 'status': 1, 'pip': 1, 'install': 1})
+        self.assertEqual(self.stats(), (2, 3, 7))
+        self.assertConsistent()
+        rebase, status = self.ids('git')
+        # Rare term comes first although it occurs less
+        self.assertEqual(dict(self.cache.indexes(self.project, 'git'))[rebase][3],
+                         ['rebase', 'git'])
+
+        # Keywords of the first snippet are changed, the second is replaced
+        self.dump({'git': [self.item('rebase', 'Rebase onto branch', ['git', 'rebase', 'onto']),
+                           self.item('commit', 'Commit changes', ['git', 'commit'])]})
+        self.assertEqual(self.df(), {'git': 2, 'rebase': 1, 'onto': 1, 'commit': 1,
+                                     'pip': 1, 'install': 1})
+        self.assertEqual(self.stats(), (2, 3, 7))
+        self.assertConsistent()
+        self.assertEqual(self.ids('git')[0], rebase)
+        commit = self.ids('git')[1]
+        self.assertEqual(self.cache.changes(), {self.project: {
+            'added': [commit], 'modified': [rebase], 'removed': [status]}})
+
+        self.dump({'pip': None})
+        self.assertEqual(self.df(), {'git': 2, 'rebase': 1, 'onto': 1, 'commit': 1})
+        self.assertEqual(self.stats(), (1, 2, 5))
+        self.assertConsistent()
+        self.assertEqual(self.ids('pip'), [])
+
+        self.dump({'git': None})
+        self.assertEqual(self.df(), {})
+        self.assertEqual(self.stats(), (0, 0, 0))
+        self.assertConsistent()
+
+
+class TestSearch(CacheTestCase):
+    def setUp(self):
+        super().setUp()
+        self.dump({'git': [self.item('rebase', 'Rebase', ['rebase', 'rebase', 'git']),
+                           self.item('onto', 'Rebase onto', ['rebase', 'git', 'branch', 'onto', 'main']),
+                           self.item('status', 'Status', ['git', 'status'])]})
+        self.rebase, self.onto, self.status = self.ids('git')
+
+
+    def search(self, query, **kwargs):
+        return [index_id for index_id, _ in self.cache.search(query, **kwargs)]
+
+
+    def test_postings(self):
+        conn = self.cache.conn(self.project)
+        self.assertEqual(sorted(conn.execute('SELECT term, tf, length FROM postings WHERE id = ?',
+                                             (self.rebase,))),
+                         [('git', 1, 3), ('rebase', 2, 3)])
+
+
+    def test_order(self):
+        # Higher term frequency and shorter snippet come first
+        self.assertEqual(self.search('rebase'), [self.rebase, self.onto])
+        self.assertEqual(self.search('git'), [self.status, self.rebase, self.onto])
+        # Rare term weighs more
+        self.assertEqual(self.search('git onto'), [self.onto, self.status, self.rebase])
+        self.assertEqual(self.search('git', limit=2), [self.status, self.rebase])
+        self.assertEqual(self.search('commit'), [])
+
+
+    def test_filter(self):
+        self.assertEqual(self.search('git', kinds='c'), [self.status, self.rebase, self.onto])
+        self.assertEqual(self.search('git', kinds='d'), [])
+        self.assertEqual(self.search('git', projects=['other']), [])
+
+
+    def test_edit(self):
+        self.dump({'git': [self.item('rebase', 'Rebase', ['git']),
+                           self.item('onto', 'Rebase onto', ['rebase', 'git', 'branch', 'onto', 'main'])]})
+        self.assertEqual(self.search('rebase'), [self.onto])
+        self.assertEqual(self.search('status'), [])
+        self.assertEqual(self.search('git'), [self.rebase, self.onto])
+        self.assertConsistent()
+
+
+class TestComplete(CacheTestCase):
+    def setUp(self):
+        super().setUp()
+        self.dump({'zh': [self.item('zh', '中文分词', ['中文', '分词']),
+                          self.item('zh2', '中文文档', ['中文', '文档'])],
+                   'en': [self.item('en', 'git rebase', ['git', 'rebase'])]})
+
+
+    def test_keyword(self):
+        self.assertEqual(self.cache.complete('reb'), ['rebase'])
+        # Keyword of more indexes comes first
+        self.assertEqual(self.cache.complete('zw'), ['中文'])
+        self.assertEqual(self.cache.complete('zhongw'), ['中文'])
+        self.assertEqual(self.cache.complete('w'), ['文档'])
+
+
+    def test_initials_of_keywords(self):
+        self.assertEqual(self.cache.complete('zwfc'), ['中文分词'])
+        self.assertEqual(self.cache.complete('zwf'), ['中文分词'])
+        self.assertEqual(self.cache.complete('zwwd'), ['中文文档'])
+        # Only Chinese keywords are joined
+        self.assertEqual(self.cache.complete('gitreb'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
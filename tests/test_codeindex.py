@@ -0,0 +1,60 @@
+"""
+    tests.test_codeindex
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Tests of :mod:`sphinxnotes.snippet.utils.codeindex`.
+
+    :copyright: Copyright 2021 Shengyu Zhang
+    :license: BSD, see LICENSE for details.
+"""
+
+import unittest
+import random
+
+from sphinxnotes.snippet.utils.codeindex import (tokenize, postings, encode_positions,
+                                                 decode_positions)
+
+
+class TestPositions(unittest.TestCase):
+    def test_roundtrip(self):
+        for positions in [[], [0], [0, 1, 2], [127, 128], [5, 300, 16384, 2**21 + 7]]:
+            self.assertEqual(decode_positions(encode_positions(positions)), positions)
+
+    def test_varint(self):
+        # Small deltas take one byte each
+        self.assertEqual(encode_positions([1, 2, 129]), bytes([1, 1, 127]))
+        self.assertEqual(len(encode_positions([128])), 2)
+        self.assertEqual(len(encode_positions([2**14])), 3)
+
+    def test_random(self):
+        rand = random.Random(0)
+        for _ in range(200):
+            positions = sorted(rand.sample(range(2**20), rand.randint(0, 50)))
+            self.assertEqual(decode_positions(encode_positions(positions)), positions)
+
+
+class TestTokenize(unittest.TestCase):
+    def test_words(self):
+        self.assertEqual(tokenize('git rebase --onto main', 'python'),
+                         [['git'], ['rebase'], ['onto'], ['main']])
+        self.assertEqual(tokenize('Foo.bar(BAZ)'), [['foo'], ['bar'], ['baz']])
+
+    def test_shell(self):
+        self.assertEqual(tokenize('git rebase --onto main', 'console'),
+                         [['git'], ['rebase'], ['--onto'], ['main']])
+        self.assertEqual(tokenize('ls -la', 'bash'), [['ls'], ['-la']])
+
+    def test_shell_path(self):
+        # Components of path are at the same position as path
+        self.assertEqual(tokenize('/usr/bin/env python3', 'sh'),
+                         [['/usr/bin/env', 'usr', 'bin', 'env'], ['python3']])
+        self.assertEqual(tokenize('cat ~/.vimrc', 'console'),
+                         [['cat'], ['~/.vimrc', 'vimrc']])
+
+    def test_postings(self):
+        self.assertEqual(postings('cd /tmp && cd tmp', 'console'),
+                         {'cd': [0, 2], '/tmp': [1], 'tmp': [1, 3]})
+
+
+if __name__ == '__main__':
+    unittest.main()
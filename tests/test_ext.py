@@ -0,0 +1,223 @@
+"""
+    tests.test_ext
+    ~~~~~~~~~~~~~~
+
+    Tests of :mod:`sphinxnotes.snippet.ext`, by building small projects.
+
+    :copyright: Copyright 2021 Shengyu Zhang
+    :license: BSD, see LICENSE for details.
+"""
+
+import unittest
+import tempfile
+import shutil
+import sys
+import io
+import os
+import subprocess
+import json
+from os import path
+
+from sphinx.application import Sphinx
+
+from sphinxnotes.snippet.cache import Cache
+
+CONF = '''\
+import os, sys
+sys.path.insert(0, os.path.abspath('.'))
+project = 'test'
+extensions = ['sphinx.ext.autodoc', 'sphinxnotes.snippet.ext']
+snippet_config = {'cache_dir': %r}
+'''
+
+
+class BuildTestCase(unittest.TestCase):
+    """Test case that builds a project in temporary directory."""
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.srcdir = path.join(self.tmpdir, 'src')
+        self.cache_dir = path.join(self.tmpdir, 'cache')
+        os.makedirs(self.srcdir)
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+
+    def build(self, files, **confoverrides):
+        """Build project of given files, return the snippet cache."""
+        files = dict(files, **{'conf.py': CONF % self.cache_dir})
+        for name, content in files.items():
+            with open(path.join(self.srcdir, name), 'w') as f:
+                f.write(content)
+        app = Sphinx(self.srcdir, self.srcdir, path.join(self.tmpdir, 'build'),
+                     path.join(self.tmpdir, 'doctrees'), 'snippet',
+                     confoverrides=confoverrides,
+                     status=io.StringIO(), warning=io.StringIO())
+        app.build()
+        self.assertEqual(app.statuscode, 0)
+        cache = Cache(self.cache_dir)
+        cache.load()
+        return cache
+
+
+    def items(self, cache, docname='index'):
+        """Return items of document, in order of position."""
+        index_ids = [index_id for index_id, _ in cache.indexes('test', docname)]
+        items = cache.get_many(index_ids)
+        return [(index_id, items[index_id][1]) for index_id in index_ids]
+
+
+    def cli(self, *args, stdin='', options=()):
+        """Run command line tool on cache of project."""
+        confpy = path.join(self.tmpdir, 'cli.py')
+        with open(confpy, 'w') as f:
+            f.write('cache_dir = %r\n' % self.cache_dir)
+        env = dict(os.environ, PYTHONPATH=path.dirname(path.dirname(path.abspath(__file__))))
+        return subprocess.run([sys.executable, *options, '-m', 'sphinxnotes.snippet.cli',
+                               '--config', confpy, *args],
+                              input=stdin, capture_output=True, text=True, env=env)
+
+
+AUTODOC_INDEX = '''\
+Autodoc
+=======
+
+Show status:
+
+.. code:: console
+
+   $ git status
+
+.. automodule:: snippet_test_mod
+   :members:
+'''
+
+AUTODOC_MODULE = '''\
+"""Module whose docstrings have snippets."""
+
+def rebase():
+    """
+    Rebase onto another branch:
+
+    .. code:: console
+
+       $ git rebase --onto main feature
+    """
+'''
+
+
+class TestAutodoc(BuildTestCase):
+    def tearDown(self):
+        sys.modules.pop('snippet_test_mod', None)
+        super().tearDown()
+
+
+    def test_build(self):
+        """Snippets whose source is not a file do not break build."""
+        cache = self.build({'index.rst': AUTODOC_INDEX,
+                            'snippet_test_mod.py': AUTODOC_MODULE})
+        items = cache.get_many([index_id for index_id, _ in self.items(cache)])
+        self.assertEqual(len(items), 3)
+        snapshots = cache.snapshots(items)
+        # Snippets of file have snapshots, snippets of docstring have not
+        for index_id, (_, item) in items.items():
+            filename = item.snippet.file()
+            self.assertEqual(index_id in snapshots, path.isfile(filename), filename)
+        self.assertEqual(len(snapshots), 2)
+        # Docstring is not the end of code snippet of file
+        code = self.items(cache)[1][1].snippet
+        self.assertEqual(code.file(), path.join(self.srcdir, 'index.rst'))
+        self.assertEqual(code.scope(), (4, 11))
+
+
+    def test_get_text(self):
+        """Text of snippet whose source is not a file is reported unavailable."""
+        cache = self.build({'index.rst': AUTODOC_INDEX,
+                            'snippet_test_mod.py': AUTODOC_MODULE})
+        index_ids = [index_id for index_id, item in self.items(cache)
+                     if not path.isfile(item.snippet.file())]
+        self.assertEqual(len(index_ids), 1)
+        index_id = index_ids[0]
+
+        proc = self.cli('get', '--text', index_id)
+        self.assertEqual(proc.returncode, 1)
+        self.assertEqual(proc.stderr, 'source of %s is not available\n' % index_id)
+
+        proc = self.cli('get', '--json', '--text', '-', stdin=' '.join(x for x, _ in self.items(cache)))
+        self.assertEqual(proc.returncode, 1)
+        self.assertEqual(proc.stderr, 'source of %s is not available\n' % index_id)
+        self.assertEqual(len([json.loads(x) for x in proc.stdout.splitlines()]), 2)
+
+
+HIGHLIGHT_INDEX = '''\
+Highlight
+=========
+
+Show status of repository::
+
+   $ git status
+
+Print explicit language:
+
+.. code:: console
+
+   $ echo explicit
+
+.. highlight:: default
+
+Not picked::
+
+   $ echo default
+
+.. highlight:: python
+
+Print hello:
+
+.. code::
+
+   print('hello')
+'''
+
+
+class TestHighlight(BuildTestCase):
+    def test_language(self):
+        """Literal blocks without language follow highlight settings."""
+        cache = self.build({'index.rst': HIGHLIGHT_INDEX}, highlight_language='console')
+        codes = [item.snippet for _, item in self.items(cache) if item.snippet.kind() == 'c']
+        self.assertEqual([(x.language(), x.astext()) for x in codes],
+                         [('console', 'Show status of repository:'),
+                          ('console', 'Print explicit language:'),
+                          ('python', 'Print hello:')])
+        self.assertEqual(codes[0].scope(), (4, 8))
+
+
+class TestChanges(BuildTestCase):
+    def test_noop_build(self):
+        """Changes are of the last build, even if it changes nothing."""
+        cache = self.build({'index.rst': HIGHLIGHT_INDEX})
+        self.assertEqual({k: len(v) for k, v in cache.changes()['test'].items()}, {'added': 3})
+        cache = self.build({})
+        self.assertEqual(cache.changes(), {})
+
+        proc = self.cli('stat')
+        self.assertEqual(proc.returncode, 0)
+        self.assertNotIn('since last build', proc.stdout)
+
+
+class TestCommandLine(BuildTestCase):
+    def test_lazy_import(self):
+        """Subcommands that only read cache do not import docutils."""
+        cache = self.build({'index.rst': HIGHLIGHT_INDEX})
+        index_id = self.items(cache)[1][0]
+        for args in [('get', '--file', '--text', index_id), ('search', 'status'),
+                     ('list',), ('stat',), ('related', index_id), ('complete', 'sta')]:
+            proc = self.cli(*args, options=('-X', 'importtime'))
+            self.assertEqual(proc.returncode, 0, args)
+            imported = [line.rsplit('|', 1)[1].strip() for line in proc.stderr.splitlines()
+                        if line.startswith('import time:')]
+            self.assertFalse([x for x in imported if x.startswith(('docutils', 'sphinx.'))], args)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,142 @@
+"""
+    tests.test_linetable
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Tests of :class:`sphinxnotes.snippet.LineTable` and snippet picking.
+
+    :copyright: Copyright 2021 Shengyu Zhang
+    :license: BSD, see LICENSE for details.
+"""
+
+import unittest
+import tempfile
+import weakref
+import gc
+import os
+
+from docutils import nodes
+from docutils.core import publish_doctree
+
+from sphinxnotes.snippet import LineTable, line_of_start, line_of_end, clear_line_counts
+from sphinxnotes.snippet.picker import pick
+
+DOCUMENT = '''\
+Title
+=====
+
+Subtitle
+--------
+
+Description of code:
+
+.. code:: console
+
+   $ git rebase --onto main
+
+.. note:: Post description.
+
+Section
+-------
+
+* Item
+
+  .. code:: python
+
+     print('hello')
+
+Term
+   Definition of term.
+
+   Nested section is not allowed, so a nested list:
+
+   1. First
+   2. Second
+
+Last paragraph
+spans two lines.
+'''
+
+
+class TestLineTable(unittest.TestCase):
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp(suffix='.rst')
+        with os.fdopen(fd, 'w') as f:
+            f.write(DOCUMENT)
+        clear_line_counts()
+
+
+    def tearDown(self):
+        os.remove(self.filename)
+        clear_line_counts()
+
+
+    def parse(self):
+        doctree = publish_doctree(DOCUMENT, source_path=self.filename,
+                                  settings_overrides={'report_level': 5,
+                                                      'doctitle_xform': False})
+        # Parser states of docutils refer to the parsed doctree, use a copy
+        # so that the doctree is only held by us
+        doctree = doctree.deepcopy()
+        for node in doctree.traverse():
+            node.document = doctree
+            # Language of code is set by directive of Sphinx, if it is not
+            # registered, take it from classes set by docutils
+            if isinstance(node, nodes.literal_block) and 'language' not in node:
+                node['language'] = node['classes'][-1]
+        return doctree
+
+
+    def test_scope(self):
+        doctree = self.parse()
+        table = LineTable(doctree)
+        n = 0
+        for node in doctree.traverse(nodes.Element):
+            if not node.line:
+                continue
+            n += 1
+            self.assertEqual(table.scope(node), (line_of_start(node), line_of_end(node)),
+                             node.tagname)
+        self.assertGreater(n, 10)
+
+
+    def test_sources(self):
+        """Nodes of other source are not the end of node."""
+        doctree = self.parse()
+        bullet_list = next(iter(doctree.traverse(nodes.bullet_list)))
+        for node in bullet_list.traverse():
+            node.source = 'mymod.py:docstring of mymod.foo'
+        table = LineTable(doctree)
+        for node in doctree.traverse(nodes.Element):
+            if node.line:
+                self.assertEqual(table.scope(node), (line_of_start(node), line_of_end(node)),
+                                 node.tagname)
+        # Bullet list is skipped, title of section ends at the definition list
+        title = bullet_list.parent[0]
+        definition_list = next(iter(doctree.traverse(nodes.definition_list)))
+        self.assertEqual(table.scope(title), (line_of_start(title),
+                                              line_of_start(definition_list[0])))
+
+
+    def test_pick(self):
+        picked = pick(self.parse())
+        self.assertEqual([x.kind() for x, _ in picked], ['d', 'c', 'c'])
+        for snippet, _ in picked:
+            nodes_ = snippet.nodes()
+            start = min(line_of_start(x) for x in nodes_ if x.line)
+            end = max(line_of_end(x) for x in nodes_ if x.line)
+            self.assertEqual(list(snippet.scope()), [start, end])
+
+
+    def test_release(self):
+        """Doctree is not held after snippets are dropped."""
+        doctree = self.parse()
+        ref = weakref.ref(doctree)
+        records = [snippet.record() for snippet, _ in pick(doctree)]
+        self.assertTrue(records)
+        del doctree
+        gc.collect()
+        self.assertIsNone(ref())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+"""
+    tests.test_trigram
+    ~~~~~~~~~~~~~~~~~~
+
+    Tests of :mod:`sphinxnotes.snippet.utils.trigram`.
+
+    :copyright: Copyright 2021 Shengyu Zhang
+    :license: BSD, see LICENSE for details.
+"""
+
+import unittest
+import random
+
+from sphinxnotes.snippet.utils.trigram import (trigrams, pattern_grams, candidate_grams,
+                                               substring_distance)
+
+
+def common_grams(grams, text):
+    """Return number of grams that are prefixes of trigrams of text."""
+    text_grams = trigrams([text])
+    return sum(any(x.startswith(g) for x in text_grams) for g in grams)
+
+
+class TestSubstringDistance(unittest.TestCase):
+    def test_exact(self):
+        self.assertEqual(substring_distance('rebase', 'git rebase -i', 2), 0)
+        self.assertEqual(substring_distance('REBASE', 'git rebase -i', 0), 0)
+
+    def test_edits(self):
+        # Deletion, insertion and substitution
+        self.assertEqual(substring_distance('rebse', 'git rebase', 2), 1)
+        self.assertEqual(substring_distance('rebaase', 'git rebase', 2), 1)
+        self.assertEqual(substring_distance('rebasx', 'git rebase', 2), 1)
+        self.assertEqual(substring_distance('rbse', 'git rebase', 2), 2)
+
+    def test_bound(self):
+        self.assertEqual(substring_distance('xyz', 'git rebase', 0), 1)
+        self.assertEqual(substring_distance('xyzw', 'git rebase', 1), 2)
+
+
+class TestCandidateGrams(unittest.TestCase):
+    def test_trigrams(self):
+        self.assertEqual(candidate_grams('rebase', 1),
+                         ({'reb', 'eba', 'bas', 'ase'}, 1))
+
+    def test_short_pattern(self):
+        # Too short for trigrams with distance 1, bigrams are used
+        grams, threshold = candidate_grams('rebse', 1)
+        self.assertEqual(grams, pattern_grams('rebse', 2))
+        self.assertEqual(threshold, 2)
+        # Characters
+        self.assertEqual(candidate_grams('ab', 1), ({'a', 'b'}, 1))
+        # Pattern shorter than trigram matches prefix of trigrams
+        self.assertEqual(candidate_grams('ab', 0), ({'ab'}, 1))
+        # No filter at all
+        self.assertEqual(candidate_grams('a', 1), (set(), 0))
+        self.assertEqual(candidate_grams('', 0), (set(), 0))
+
+    def test_bound(self):
+        """Strings that match pattern never fall below the bound."""
+        rand = random.Random(0)
+        alphabet = 'abcd'
+        for _ in range(2000):
+            pattern = ''.join(rand.choice(alphabet) for _ in range(rand.randint(1, 7)))
+            text = ''.join(rand.choice(alphabet) for _ in range(rand.randint(0, 12)))
+            distance = rand.randint(0, 2)
+            if substring_distance(pattern, text, distance) > distance:
+                continue
+            grams, threshold = candidate_grams(pattern, distance)
+            self.assertGreaterEqual(common_grams(grams, text), threshold,
+                                    (pattern, text, distance))
+
+
+if __name__ == '__main__':
+    unittest.main()